@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+import pytest
+import skimage.io
+import tifffile
+
+from yeaz.disk.image_loader import image_shape
+from yeaz.disk.Reader import Reader
+
+
+@pytest.mark.parametrize('shape', [(3, 40, 50), (4, 40, 50), (5, 40, 50)])
+def test_image_shape_of_tiff_stack_matches_imread(tmp_path, shape):
+    path = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(path, np.zeros(shape, dtype=np.uint16))
+    assert image_shape(path) == skimage.io.imread(path).shape
+
+
+@pytest.mark.parametrize('npages', [3, 4])
+def test_folder_of_tiff_stacks_loads(tmp_path, npages):
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    rng = np.random.default_rng(0)
+    for t in range(2):
+        im = rng.integers(0, 1000, (npages, 40, 50), dtype=np.uint16)
+        tifffile.imwrite(str(folder / 'im{}.tif'.format(t)), im)
+
+    reader = Reader('', str(tmp_path / 'masks.h5'), str(folder))
+    assert reader.sizet == 2
+    for t in range(2):
+        expected = skimage.io.imread(str(folder / 'im{}.tif'.format(t)))
+        im = reader.LoadOneImage(t, 0)
+        np.testing.assert_array_equal(im, np.moveaxis(expected, -1, 0)[0])
@@ -53,7 +53,6 @@ usual buttons (because the Cell Correspondence makes also mistakes).
 import sys
 import numpy as np
 import pandas as pd
-import h5py
 import skimage
 
 # For writing excel files
@@ -115,9 +114,12 @@ from .misc.PlotCanvas import PlotCanvas
 
 from .misc import Extract as extr
 
-from .disk.image_loader import load_image
-from .nns.segment import segment
+from .disk.image_loader import load_image, image_hash
+from .nns.segment import segment_many, SegmentationPool
+from .disk.prediction_cache import PredictionCache, prediction_key, prediction_attrs
 from .nns import neural_network as nn
+from .nns import preprocessing
+from .nns.preprocessing import PREPROCESSING
 from .misc.ProgressBar import ProgressBar
 
 from .nns import gcn as gcn
@@ -449,29 +451,24 @@ class App(QMainWindow):
         self.WriteStatusBar('Extracting ...')
         
         # Get last image with mask
-        for time_index in range(self.reader.sizet-1, -1, -1):            
-            # Test if time has a mask
-            file = h5py.File(self.reader.hdfpath, 'r+')
-            time_exist = self.reader.TestTimeExist(time_index, self.FOVindex, file)
-            file.close()
+        with self.reader:
+            # only iterate over the frames which have a mask
+            for time_index in reversed(self.reader.ExistingFrames(self.FOVindex)):
             
-            if not time_exist:
-                continue
+                # load picture and sheet
+                image = self.reader.LoadImageChannel(time_index, self.FOVindex, 
+                                                     self.reader.default_channel)
+                mask = self.reader.LoadMask(time_index, self.FOVindex)
             
-            # load picture and sheet
-            image = self.reader.LoadImageChannel(time_index, self.FOVindex, 
-                                                 self.reader.default_channel)
-            mask = self.reader.LoadMask(time_index, self.FOVindex)
+                # Break if mask is non-empty
+                if mask.sum()>0:
+                    break
             
-            # Break if mask is non-empty
-            if mask.sum()>0:
-                break
-            
-            if time_index==0:
-                msg_box = QMessageBox(QMessageBox.Icon.Critical, 'Error', 'No mask found', parent=self)
-                msg_box.exec()
-                self.Enable(self.button_extractfluorescence)
-                self.ClearStatusBar()
+                if time_index==0:
+                    msg_box = QMessageBox(QMessageBox.Icon.Critical, 'Error', 'No mask found', parent=self)
+                    msg_box.exec()
+                    self.Enable(self.button_extractfluorescence)
+                    self.ClearStatusBar()
         
         # Launch dialog with last image
         dlg = extr.Extract(image, mask, self.reader.channel_names)
@@ -490,20 +487,14 @@ class App(QMainWindow):
         specified by the cell_list"""
         
         mask_list = []
-        for time_index in range(0, self.reader.sizet):
+        with self.reader:
+            # only iterate over the frames which have a mask
+            for time_index in self.reader.ExistingFrames(self.FOVindex):
             
-            # Test if time has a mask
-            file = h5py.File(self.reader.hdfpath, 'r+')
-            time_exist = self.reader.TestTimeExist(time_index, self.FOVindex, file)
-            file.close()
-            
-            if not time_exist:
-                continue
-            
-            mask = self.reader.LoadMask(time_index, self.FOVindex)
-            for cell in desel_cells:
-                mask[mask==cell] = 0
-            mask_list.append(mask)
+                mask = self.reader.LoadMask(time_index, self.FOVindex)
+                for cell in desel_cells:
+                    mask[mask==cell] = 0
+                mask_list.append(mask)
             
         imageio.mimwrite(outfile, np.array(mask_list, dtype=np.uint16))
                         
@@ -545,44 +536,39 @@ class App(QMainWindow):
         # List of cell properties
         cell_list = []
 
-        for time_index in range(0, self.reader.sizet):
-            # Test if time has a mask
-            file = h5py.File(self.reader.hdfpath, 'r+')
-            time_exist = self.reader.TestTimeExist(time_index, self.FOVindex, file)
-            file.close()
-            
-            if not time_exist:
-                continue
+        with self.reader:
+            # only iterate over the frames which have a mask
+            for time_index in self.reader.ExistingFrames(self.FOVindex):
             
-            mask = self.reader.LoadMask(time_index, self.FOVindex)
+                mask = self.reader.LoadMask(time_index, self.FOVindex)
             
-            for channel in channel_list:
-                # check if channel is in list of nd2 channels
-                try:
-                    channel_ix = self.reader.channel_names.index(channel)
-                    image = self.reader.LoadImageChannel(time_index, self.FOVindex, channel_ix)
+                for channel in channel_list:
+                    # check if channel is in list of nd2 channels
+                    try:
+                        channel_ix = self.reader.channel_names.index(channel)
+                        image = self.reader.LoadImageChannel(time_index, self.FOVindex, channel_ix)
                 
-                # channel is a file
-                except ValueError:
-                    image = load_image(channel, ix=time_index)
+                    # channel is a file
+                    except ValueError:
+                        image = load_image(channel, ix=time_index)
                     
-                for val in np.unique(mask):
-                    # bg is not cell
-                    if val == 0:
-                        continue
-                    # disregard cells not in cell_list
-                    if (val in desel_cells):
-                        continue
+                    for val in np.unique(mask):
+                        # bg is not cell
+                        if val == 0:
+                            continue
+                        # disregard cells not in cell_list
+                        if (val in desel_cells):
+                            continue
                     
-                    # Calculate stats
-                    stats = {'Cell': val,
-                             'Time': time_index,
-                             'Channel': channel}
+                        # Calculate stats
+                        stats = {'Cell': val,
+                                 'Time': time_index,
+                                 'Channel': channel}
                     
-                    stats = {**stats,
-                             **self.cell_statistics(image, mask == val)}
-                    stats['Disappeared in video'] = not (val in sel_cells)
-                    cell_list.append(stats)
+                        stats = {**stats,
+                                 **self.cell_statistics(image, mask == val)}
+                        stats['Disappeared in video'] = not (val in sel_cells)
+                        cell_list.append(stats)
                     
         
         # Use Pandas to write csv
@@ -738,35 +724,60 @@ class App(QMainWindow):
                 device = 'cuda'
             else:
                 device = 'cpu'
+            precision = dlg.precision.currentData()
             tracker = None
             if(dlg.tracker.currentData() == 'GCN'):
                 tracker = 'GCN'
             else:
                 tracker = 'Hungarian'
             
-            for item in tqdm.tqdm(dlg.listfov.selectedItems(), desc='FOV', position=0, leave=True):
-                #iterates over the time indices in the range
-                for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Segmenting', position=1, leave=True):                    
-                    #calls the neural network for time t and selected
-                    #fov
-                    if dlg.entry_threshold.text() !=  '':
-                        thr_val = float(dlg.entry_threshold.text())
-                    else:
-                        thr_val = None
-                    if dlg.entry_segmentation.text() != '':
-                        seg_val = int(dlg.entry_segmentation.text())
-                    else:
-                        seg_val = 10
-                    
-                    self.PredThreshSeg(t, dlg.listfov.row(item), thr_val, seg_val,
-                                       mic_type, device=device)
-                print('--------- Finished segmenting.')
-                if tracker == "GCN" and mic_type == 'fission':
-                    gcn.start_tracking_fission(self.reader, dlg.listfov.row(item), time_value1, time_value2)
-                elif tracker == 'GCN':
-                    gcn.start_tracking(self.reader, dlg.listfov.row(item), time_value1, time_value2)
-                elif tracker =='Hungarian': # Hungarian
-                    hu.start_tracking(self.reader, dlg.listfov.row(item), time_value1, time_value2)
+            if dlg.entry_threshold.text() !=  '':
+                thr_val = float(dlg.entry_threshold.text())
+            else:
+                thr_val = None
+            if dlg.entry_segmentation.text() != '':
+                seg_val = int(dlg.entry_segmentation.text())
+            else:
+                seg_val = 10
+            
+            # the predictions are segmented in parallel by a pool of worker
+            # processes, a chunk of frames at a time, with no more processes
+            # than frames
+            frames = list(range(time_value1, time_value2+1))
+            n_workers = max(1, min(os.cpu_count() or 1, len(frames)))
+            
+            # the predictions are stored next to the mask file and reused, 
+            # such that segmenting again with other values skips the network
+            cache, key = None, None
+            if dlg.reuse_predictions.isChecked():
+                try:
+                    key = prediction_key(nn.get_weights_path(mic_type), PREPROCESSING, precision)
+                    cache = PredictionCache(PredictionCache.PathFor(self.reader.hdfpath))
+                except OSError:
+                    log.warning('The predictions are not stored, the weights file is missing')
+            
+            with self.reader, SegmentationPool(n_workers) as pool:
+                for item in tqdm.tqdm(dlg.listfov.selectedItems(), desc='FOV', position=0, leave=True):
+                    #iterates over the time indices in the range
+                    for start in tqdm.tqdm(range(0, len(frames), n_workers), desc='Segmenting', position=1, leave=True):                    
+                        #calls the neural network for the chunk of time 
+                        #indices and selected fov
+                        self.PredThreshSegMany(frames[start:start+n_workers], dlg.listfov.row(item), 
+                                               thr_val, seg_val, mic_type, device=device, pool=pool,
+                                               cache=cache, key=key, precision=precision)
+                    print('--------- Finished segmenting.')
+                    if tracker == "GCN" and mic_type == 'fission':
+                        gcn.start_tracking_fission(self.reader, dlg.listfov.row(item), time_value1, time_value2)
+                    elif tracker == 'GCN':
+                        gcn.start_tracking(self.reader, dlg.listfov.row(item), time_value1, time_value2)
+                    elif tracker =='Hungarian': # Hungarian
+                        hu.start_tracking(self.reader, dlg.listfov.row(item), time_value1, time_value2)
+            # the model is kept loaded for the next runs, except on the gpu
+            # where memory is scarce
+            if device == 'cuda':
+                nn.evict_models(device='cuda')
+            if cache is not None:
+                cache.Close()
             self.ReloadThreeMasks()
         reset()
 
@@ -781,34 +792,64 @@ class App(QMainWindow):
         Then it segments the thresholded prediction and saves the
         segmentation. 
         """
-        log.debug('--------- Segmenting field of view:',fovindex,'Time point:',timeindex)
-        im = self.reader.LoadOneImage(timeindex, fovindex)
-        try:
-            pred = self.LaunchPrediction(im, mic_type, device=device)
-        except ValueError:
-            msg_box = QMessageBox(QMessageBox.Icon.Critical,'Error',
-                                 'The neural network weight files could not '
-                                 'be found. Make sure to download them from '
-                                 'the link in the readme and put them into '
-                                 'the folder nns', parent=self)
-            msg_box.exec()
-            
-            return
-
-        thresh = self.ThresholdPred(thr_val, pred)
-        seg = segment(thresh, pred, seg_val)
-        self.reader.SaveMask(timeindex, fovindex, seg)
+        self.PredThreshSegMany([timeindex], fovindex, thr_val, seg_val, 
+                               mic_type, device=device)
+        
+        
+    def PredThreshSegMany(self, timeindices, fovindex, thr_val, seg_val,
+                          mic_type, device=None, pool=None, cache=None, key=None, 
+                          precision='float32'):
+        """
+        Same as PredThreshSeg for all the time indices in timeindices. The 
+        predictions of the neural network are thresholded and segmented in 
+        parallel by the worker processes of pool (see segment.segment_many), 
+        or in this process if pool is None. If a PredictionCache is given, 
+        the predictions stored under key are reused and the new ones stored.
+        precision is the precision of the neural network, see 
+        nn.inference_context.
+        """
+        log.debug('--------- Segmenting field of view: {} Time points: {}'.format(fovindex, timeindices))
+        preds = []
+        for timeindex in timeindices:
+            im = self.reader.LoadOneImage(timeindex, fovindex)
+            if cache is not None:
+                # only reused if the image did not change
+                attrs = prediction_attrs(image_hash(im))
+                pred = cache.LoadPrediction(timeindex, fovindex, key, attrs)
+                if pred is not None:
+                    preds.append(pred)
+                    continue
+            try:
+                pred = self.LaunchPrediction(im, mic_type, device=device, precision=precision)
+            except ValueError:
+                msg_box = QMessageBox(QMessageBox.Icon.Critical,'Error',
+                                     'The neural network weight files could not '
+                                     'be found. Make sure to download them from '
+                                     'the link in the readme and put them into '
+                                     'the folder nns', parent=self)
+                msg_box.exec()
+                
+                return
+            if cache is not None:
+                cache.SavePrediction(timeindex, fovindex, key, pred, attrs)
+            preds.append(pred)
+
+        segs = segment_many(preds, thr_val, seg_val, n_workers=1, pool=pool)
+        for timeindex, seg in zip(timeindices, segs):
+            self.reader.SaveMask(timeindex, fovindex, seg)
+            # the record of the command line (image hash and parameters)
+            # does not describe this mask anymore, see SegmentFOV
+            self.reader.SaveMaskAttrs(timeindex, fovindex, {})
         log.debug('--------- Finished segmenting.')
           
           
     @staticmethod
-    def LaunchPrediction(im, mic_type, pretrained_weights=None, device=None):
+    def LaunchPrediction(im, mic_type, pretrained_weights=None, device=None, precision='float32'):
         """It launches the neural neutwork on the current image and creates 
         an hdf file with the prediction for the time T and corresponding FOV. 
         """
-        im = skimage.exposure.equalize_adapthist(im)
-        im = im*1.0;	
-        pred = nn.prediction(im, mic_type, pretrained_weights, device=device)
+        im = preprocessing.equalize_adapthist(im)
+        pred = nn.prediction(im, mic_type, pretrained_weights, device=device, precision=precision)
         return pred
 
 
@@ -6,8 +6,14 @@
 #
 # python Launch_NN_command_line.py -i DIRECTORY/IMAGE_FILE -m OUTPUT_MASK_FILE --image_type pc_OR_bf               --fov N --range_of_frames n1 n2 --min_seed_dist 5 --threshold 0.5
 
+import os
+import json
 import time
 import tqdm
+import functools
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import sys
 
@@ -16,36 +22,194 @@ import sys
 #and masks and it also runs the neural network.
 
 
-from yeaz.nns.segment import segment
+from yeaz.nns.segment import segment_prediction, SegmentationPool
 from yeaz.disk import Reader as nd
+from yeaz.disk.prediction_cache import PredictionCache, prediction_key, prediction_attrs
+from yeaz.disk.image_loader import image_hash
 import argparse
-import skimage
+import h5py
 from yeaz.nns import neural_network as nn
 from yeaz.nns import hungarian as hu
 from yeaz.nns import gcn as gcn
+from yeaz.nns import pipeline
+from yeaz.nns import preprocessing
+from yeaz.nns.preprocessing import PREPROCESSING
 
 import torch
 
-def LaunchPrediction(im, mic_type, pretrained_weights=None, device='cpu'):
-    """It launches the neural neutwork on the current image and creates 
-    an hdf file with the prediction for the time T and corresponding FOV. 
-    """
-    im = skimage.exposure.equalize_adapthist(im)
-    im = im*1.0;	
-    pred = nn.prediction(im, mic_type, pretrained_weights, device=device)
-    return pred
+def Preprocess(im):
+    """Equalizes the image with CLAHE, as expected by the neural network"""
+    return preprocessing.equalize_adapthist(im)
 
 
+def SegmentFOV(reader, fov_ind, image_type, time_value1, time_value2, thr_val, min_seed_dist, path_to_weights, f_device, tracker, 
+               batch_size=4, tile_size=None, tile_overlap=128, n_readers=1, n_seg_workers=0, queue_size=8, 
+               seg_pool=None, cache_path=None, incremental=False, precision='float32', 
+               track_max_dist=None):
+    """Segments and tracks the frames time_value1 to time_value2 of the 
+    field of view fov_ind. The predictions are segmented by the processes of
+    seg_pool, or of a new pool of n_seg_workers processes if seg_pool is None
+    (in the writer thread if n_seg_workers is 0). If cache_path is given, 
+    the predictions are stored there and the stored ones are reused.
+    
+    A hash of the input image and the parameters are recorded with every 
+    mask. If incremental is True, only the frames whose image or parameters
+    changed since they were segmented are segmented again, and the frames are
+    tracked from the first of them. track_max_dist is the max_dist of the 
+    Hungarian tracker, see hungarian.correspondence."""
+    frames = list(range(time_value1, time_value2+1))
+    weights_key = prediction_key(nn.get_weights_path(image_type, path_to_weights), PREPROCESSING, precision)
+    params = dict(weights=weights_key,
+                  threshold=thr_val, min_seed_dist=min_seed_dist, tile_size=tile_size, 
+                  tile_overlap=tile_overlap, tracker=tracker)
+    if tracker == 'Hungarian' and track_max_dist is not None:
+        params['track_max_dist'] = track_max_dist
+    params = json.dumps(params, sort_keys=True)
+    # frames which are predicted again even if a prediction is stored
+    changed_input = set()
+    if incremental:
+        # the frames are read once before to find the changed ones
+        hashes = {t: image_hash(reader.LoadOneImage(t, fov_ind)) for t in frames}
+        records = {t: reader.LoadMaskAttrs(t, fov_ind) for t in frames}
+        frames = [t for t in frames if records[t] != {'input_hash': hashes[t], 'params': params}]
+        changed_input = {t for t in frames if records[t].get('input_hash') != hashes[t]}
+        print('--------- {} frames changed.'.format(len(frames)))
+        if not frames:
+            return
+    
+    # the records are only written once the frames are segmented and tracked
+    for t in frames:
+        reader.SaveMaskAttrs(t, fov_ind, {})
+    
+    own_pool = seg_pool is None and n_seg_workers > 0
+    if own_pool:
+        seg_pool = SegmentationPool(n_seg_workers)
+    
+    cache, cached, store = None, None, None
+    if cache_path is not None:
+        cache = PredictionCache(cache_path)
+        # the stored predictions are only reused for the same image and tiling
+        attrs = lambda input_hash: prediction_attrs(input_hash, tile_size, tile_overlap)
+        cached = lambda t, input_hash: (None if t in changed_input else
+                                        cache.LoadPrediction(t, fov_ind, weights_key, attrs(input_hash)))
+        
+        def store(t, input_hash, pred):
+            # the new prediction is segmented in float32, only the stored 
+            # copy is rounded
+            cache.SavePrediction(t, fov_ind, weights_key, pred, attrs(input_hash))
+            return pred
+    
+    #segments the time indices in the range: the images are loaded,
+    #passed through the network in batches of batch_size frames, 
+    #segmented and saved by concurrent stages
+    try:
+        hashes = pipeline.run_pipeline(
+            reader, fov_ind, frames,
+            preprocess=Preprocess,
+            predict=functools.partial(nn.predict_batch, mic_type=image_type, 
+                                      pretrained_weights=path_to_weights, device=f_device, 
+                                      batch_size=batch_size, tile_size=tile_size, 
+                                      overlap=tile_overlap, precision=precision),
+            postprocess=functools.partial(segment_prediction, thr_val=thr_val, 
+                                          min_distance=min_seed_dist),
+            submit=functools.partial(seg_pool.submit, thr_val=thr_val, 
+                                     min_distance=min_seed_dist) if seg_pool is not None else None,
+            cached=cached, store=store, fingerprint=image_hash,
+            n_readers=n_readers, batch_size=batch_size, queue_size=queue_size)
+    finally:
+        if own_pool:
+            seg_pool.shutdown()
+        if cache is not None:
+            cache.Close()
+    print('--------- Finished segmenting.')
+    # from pyinstrument import Profiler
+    # with Profiler(interval=0.1) as profiler:
+    if tracker == 'Hungarian':
+        print('--------- Tracking with Hungarian algorithm.')
+        hu.start_tracking(reader, fov_ind, frames[0], time_value2, max_dist=track_max_dist)
+    elif tracker == "GCN":
+        if image_type == 'fission':
+            print('--------- Tracking with GCN for fission files.')
+            gcn.start_tracking_fission(reader, fov_ind, frames[0], time_value2)
+        else:
+            print('--------- Tracking with GCN for budding yeasts.')
+            gcn.start_tracking(reader, fov_ind, frames[0], time_value2)
+    # profiler.print()
+    
+    for t in frames:
+        reader.SaveMaskAttrs(t, fov_ind, {'input_hash': hashes[t], 'params': params})
 
-def ThresholdPred(thvalue, pred):
-    """Thresholds prediction with value"""
-    if thvalue == None:
-        thresholdedmask = nn.threshold(pred)
-    else:
-        thresholdedmask = nn.threshold(pred, thvalue)
-    return thresholdedmask
 
-def LaunchInstanceSegmentation(reader, image_type, fov_indices=[0], time_value1=0, time_value2=0, thr_val=None, min_seed_dist=5, path_to_weights=None, device='cpu', tracker='Hungarian'):
+def SegmentFOVWorker(image_path, hdfpath, fov_ind, *args, **kwargs):
+    """Runs SegmentFOV in a worker process, on its own reader of the image 
+    file and its own hdf file hdfpath"""
+    reader = nd.Reader("", hdfpath, image_path)
+    with reader:
+        SegmentFOV(reader, fov_ind, *args, **kwargs)
+    reader.CloseImageFile()
+    return fov_ind
+
+
+def SegmentFOVsInParallel(reader, fov_indices, n_workers, *args, n_threads=None, **kwargs):
+    """Segments and tracks the fields of view in n_workers processes, each 
+    running the network with n_threads threads (by default the cores are 
+    divided between the processes). Every worker writes the masks of its field of view to a temporary hdf file, 
+    which initially contains the existing masks of the field of view. The 
+    groups of the finished fields of view are then copied into the hdf file 
+    of reader as soon as they are finished, only by this process, such that 
+    the file is never written concurrently. A field of view which fails does
+    not stop the others, the failed fields of view are reported at the end 
+    and returned."""
+    fov_indices = list(dict.fromkeys(fov_indices))
+    outdir = os.path.dirname(os.path.abspath(reader.hdfpath))
+    with tempfile.TemporaryDirectory(dir=outdir, prefix='.yeaz_') as tmpdir:
+        
+        tmppaths = {}
+        with reader.HdfFile() as file:
+            for fov_ind in fov_indices:
+                tmppaths[fov_ind] = os.path.join(tmpdir, 'FOV{}.h5'.format(fov_ind))
+                with h5py.File(tmppaths[fov_ind], 'w') as tmpfile:
+                    for fovlabel in reader.fovlabels:
+                        tmpfile.create_group(fovlabel)
+                    fovlabel = reader.fovlabels[fov_ind]
+                    for tlabel in file[fovlabel].keys():
+                        file.copy(file[fovlabel][tlabel], tmpfile[fovlabel])
+        
+        # the workers are spawned and not forked, as forking a process with 
+        # a loaded network or open hdf file is not safe
+        context = multiprocessing.get_context('spawn')
+        if n_threads is None:
+            n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        with ProcessPoolExecutor(n_workers, mp_context=context, initializer=torch.set_num_threads,
+                                 initargs=(n_threads,)) as executor:
+            futures = {executor.submit(SegmentFOVWorker, reader.nd2path, tmppaths[fov_ind], 
+                                       fov_ind, *args, **kwargs): fov_ind
+                       for fov_ind in fov_indices}
+            failed = {}
+            for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc='FOV', position=0):
+                fov_ind = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # the masks of this field of view are left unchanged
+                    failed[fov_ind] = e
+                    continue
+                fovlabel = reader.fovlabels[fov_ind]
+                with reader.HdfFile() as file, h5py.File(tmppaths[fov_ind], 'r') as tmpfile:
+                    del file[fovlabel]
+                    tmpfile.copy(tmpfile[fovlabel], file, name=fovlabel)
+                    file.flush()
+                os.remove(tmppaths[fov_ind])
+                
+    reader.RefreshFrameIndex()
+    for fov_ind, e in failed.items():
+        print("Error", 'Segmentation of field of view {} failed: {!r}'.format(fov_ind, e))
+    return sorted(failed)
+
+
+def LaunchInstanceSegmentation(reader, image_type, fov_indices=[0], time_value1=0, time_value2=0, thr_val=None, min_seed_dist=5, path_to_weights=None, device='cpu', tracker='Hungarian', batch_size=4, tile_size=None, tile_overlap=128,
+                               n_readers=1, n_seg_workers=0, queue_size=8, n_workers=1, cache_predictions=False,
+                               incremental=False, precision='float32', n_threads=None, track_max_dist=None):
     if (device == 'cuda') and torch.cuda.is_available():
         f_device = 'cuda'
     else:
@@ -67,48 +231,62 @@ def LaunchInstanceSegmentation(reader, image_type, fov_indices=[0], time_value1=
         print("Error", 'Invalid Time Constraints')
         return
     
+    # check tiles constraint
+    if tile_size is not None and tile_overlap >= tile_size:
+        print("Error", 'tile_overlap must be smaller than tile_size')
+        return
+    
+    # check precision value
+    if precision not in nn.PRECISIONS:
+        print("Error", 'Invalid precision, must be one of {}'.format(nn.PRECISIONS))
+        return
+    
+    # check tracker value
+    if tracker not in ['Hungarian', 'GCN']:
+        print("Error", 'Invalid Tracker')
+        return
+    
+    # check that the neural network weights exist
+    if not os.path.exists(str(nn.get_weights_path(image_type, path_to_weights))):
+        print('Error! ',
+              'The neural network weight files could not '
+              'be found. \nMake sure to download them from '
+              'the link in the readme and put them into '
+              'the folder nns, or specify a path to a custom weights file with -w argument.')
+        return
+    
+    # number of threads used by the network on the CPU
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    
     # displays that the neural network is running
     print('Running the neural network on {} ...'.format(f_device))
     
-    for fov_ind in tqdm.tqdm(fov_indices, desc='FOV', position=0):
-
-        #iterates over the time indices in the range
-        for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Segmenting frames', leave=True):         
-            # print('--------- Segmenting field of view:',fov_ind,'Time point:',t)
-
-            #calls the neural network for time t and selected fov
-            im = reader.LoadOneImage(t, fov_ind)
-
-            try:
-                pred = LaunchPrediction(im, image_type, pretrained_weights=path_to_weights, device=f_device)
-            except ValueError:
-                print('Error! ',
-                      'The neural network weight files could not '
-                      'be found. \nMake sure to download them from '
-                      'the link in the readme and put them into '
-                      'the folder nns, or specify a path to a custom weights file with -w argument.')
-                return
-
-            thresh = ThresholdPred(thr_val, pred)
-            seg = segment(thresh, pred, min_seed_dist)
-            reader.SaveMask(t, fov_ind, seg)
-        print('--------- Finished segmenting.')
-        # from pyinstrument import Profiler
-        # with Profiler(interval=0.1) as profiler:
-        if tracker == 'Hungarian':
-            print('--------- Tracking with Hungarian algorithm.')
-            hu.start_tracking(reader, fov_ind, time_value1, time_value2)
-        elif tracker == "GCN":
-            if image_type == 'fission':
-                print('--------- Tracking with GCN for fission files.')
-                gcn.start_tracking_fission(reader, fov_ind, time_value1, time_value2)
-            else:
-                print('--------- Tracking with GCN for budding yeasts.')
-                gcn.start_tracking(reader, fov_ind, time_value1, time_value2)
+    args = (image_type, time_value1, time_value2, thr_val, min_seed_dist, path_to_weights, f_device, tracker)
+    kwargs = dict(batch_size=batch_size, tile_size=tile_size, tile_overlap=tile_overlap, 
+                  n_readers=n_readers, n_seg_workers=n_seg_workers, queue_size=queue_size,
+                  incremental=incremental, precision=precision, track_max_dist=track_max_dist)
+    
+    # the predictions are stored next to the mask file, such that the frames
+    # can be segmented again with other parameters without the network
+    if cache_predictions:
+        kwargs['cache_path'] = PredictionCache.PathFor(reader.hdfpath)
+    
+    with reader:
+        if n_workers > 1 and len(fov_indices) > 1:
+            # the fields of view are independent and sharded across processes,
+            # each of them loads its own network
+            SegmentFOVsInParallel(reader, fov_indices, min(n_workers, len(fov_indices)), *args, 
+                                  n_threads=n_threads, **kwargs)
         else:
-            print("Error", 'Invalid Tracker')
-            return
-        # profiler.print()
+            # the segmentation processes are shared by all the fields of view
+            seg_pool = SegmentationPool(n_seg_workers) if n_seg_workers > 0 else None
+            try:
+                for fov_ind in tqdm.tqdm(fov_indices, desc='FOV', position=0):
+                    SegmentFOV(reader, fov_ind, *args, **kwargs, seg_pool=seg_pool)
+            finally:
+                if seg_pool is not None:
+                    seg_pool.shutdown()
         
 def main(args):
 
@@ -121,7 +299,13 @@ def main(args):
                                args.range_of_frames[0],  args.range_of_frames[1], 
                                args.threshold, args.min_seed_dist, 
                                args.path_to_weights, device=args.device, 
-                               tracker=args.tracker)
+                               tracker=args.tracker, batch_size=args.batch_size,
+                               tile_size=args.tile_size, tile_overlap=args.tile_overlap,
+                               n_readers=args.readers, n_seg_workers=args.seg_workers, 
+                               queue_size=args.queue_size, n_workers=args.workers,
+                               cache_predictions=args.cache_predictions, incremental=args.incremental,
+                               precision=args.precision, n_threads=args.threads,
+                               track_max_dist=args.track_max_dist)
 
 if __name__ == '__main__':
     
@@ -136,5 +320,17 @@ if __name__ == '__main__':
     parser.add_argument('--min_seed_dist', default=5, type=int, help="Specify minimum distance between seeds.")
     parser.add_argument('--device', default='cpu', type=str, help="Specify device to run on (cpu or cuda).")
     parser.add_argument('--tracker', default='Hungarian', type=str, help="Specify tracker to use (Hungarian or GCN).")
+    parser.add_argument('--batch_size', default=4, type=int, help="Specify number of frames passed through the neural network at once.")
+    parser.add_argument('--tile_size', default=None, type=int, help="Specify tile size to predict large images tile by tile, which bounds the memory used.")
+    parser.add_argument('--tile_overlap', default=128, type=int, help="Specify overlap in pixels between neighbouring tiles.")
+    parser.add_argument('--readers', default=1, type=int, help="Specify number of threads loading and preprocessing images.")
+    parser.add_argument('--seg_workers', default=0, type=int, help="Specify number of processes thresholding and segmenting predictions (0 to do it in the writer thread).")
+    parser.add_argument('--queue_size', default=8, type=int, help="Specify maximal number of frames waiting between two stages of the pipeline.")
+    parser.add_argument('--workers', default=1, type=int, help="Specify number of processes segmenting and tracking different fields of view at the same time.")
+    parser.add_argument('--cache_predictions', action='store_true', help="Store the predictions of the neural network next to the mask file and reuse them, such that segmenting again with another threshold or min_seed_dist skips the neural network.")
+    parser.add_argument('--incremental', action='store_true', help="Only segment the frames whose image or parameters changed since they were last segmented, e.g. the new frames of a growing experiment.")
+    parser.add_argument('--precision', default='float32', type=str, help="Specify precision of the neural network (float32 or bfloat16). bfloat16 is faster on CPUs supporting it, at the cost of slightly different predictions, see yeaz.nns.benchmark.")
+    parser.add_argument('--threads', default=None, type=int, help="Specify number of threads of the neural network on the CPU (per process with --workers). Export the weights with python -m yeaz.nns.export to run the network faster on the CPU.")
+    parser.add_argument('--track_max_dist', default=None, type=float, help="Specify maximal distance in pixels a cell can move between two frames with the Hungarian tracker, cells further away from all cells of the previous frame are new cells. Speeds up tracking of dense colonies.")
     args = parser.parse_args()
     main(args)
@@ -8,11 +8,15 @@ loading or saving a particular image.
 """
 from nd2reader import ND2Reader
 import numpy as np
-import re
 import h5py
 import os.path
+import threading
 import skimage
 import skimage.io
+from contextlib import contextmanager
+
+from .tiff_stack import TiffStack, is_tiff
+from .image_loader import list_images, image_shapes
 
 
 import logging
@@ -44,64 +48,64 @@ class Reader:
                                             '.JPG','.JPEG','.PNG','.BMP',
                                            '.PBM','.PGM','.PPM','.PXM','.PNM','.JP2']
         
+        self.istiff = self.issingle and is_tiff(nd2pathname)
+        
         self.nd2path = nd2pathname # path name is nd2path for legacy reasons
         self.hdfpath = hdfpathname
         self.newhdfpath = newhdfname
         
+        # the nd2 file is parsed once and its handle is kept open, the lock
+        # makes sure that only one thread reads from the handle at a time
+        self._nd2 = None
+        self._tiff = None
+        self._imagelock = threading.RLock()
+        
         if self.isnd2:
-            with ND2Reader(self.nd2path) as images:
-                self.sizex = images.sizes['x']
-                self.sizey = images.sizes['y']
-                self.sizet = images.sizes['t']
-                try:
-                    self.sizec = images.sizes['c']
-                except KeyError:
-                    self.sizec = 1
-                try:
-                    self.Npos  = images.sizes['v']
-                except KeyError:
-                    self.Npos  = 1
-                self.channel_names = images.metadata['channels']
+            images = self._ND2Handle()
+            self.sizex = images.sizes['x']
+            self.sizey = images.sizes['y']
+            self.sizet = images.sizes['t']
+            try:
+                self.sizec = images.sizes['c']
+            except KeyError:
+                self.sizec = 1
+            try:
+                self.Npos  = images.sizes['v']
+            except KeyError:
+                self.Npos  = 1
+            self.channel_names = images.metadata['channels']
                 
         elif self.issingle:
 
-            im = skimage.io.imread(self.nd2path)
+            if self.istiff:
+                # only the header is read for tiff files
+                shape = self._TiffHandle().shape
+            else:
+                shape = skimage.io.imread(self.nd2path).shape
 
-            if im.ndim==3:
+            if len(shape)==3:
                 # num pages should be smaller than x or y dimension, very unlikely not to be the case
-                if im.shape[2] < im.shape[0] and im.shape[2] < im.shape[1]:  
-                    im = np.moveaxis(im, -1, 0) # move last axis to first
-                self.sizet, self.sizey, self.sizex = im.shape
+                if shape[2] < shape[0] and shape[2] < shape[1]:  
+                    shape = (shape[2], shape[0], shape[1]) # move last axis to first
+                self.sizet, self.sizey, self.sizex = shape
             else:
-                self.sizey, self.sizex = im.shape
+                self.sizey, self.sizex = shape
                 self.sizet = 1
                 
             self.Npos = 1
             self.channel_names = ['Channel1']
                 
         elif self.isfolder:
-            filelist = sorted(os.listdir(self.nd2path))  
-            # filter filelist for supported image files
-            filelist = [f for f in filelist if re.search(r".png|.tif|.jpg|.bmp|.jpeg|.pbm|.pgm|.ppm|.pxm|.pnm|.jp2"
-                                                         "|.PNG|.TIF|.JPG|.BMP|.JPEG|.PBM|.PGM|.PPM|.PXM|.PNM|.JP2", f)]          
-            for f in filelist:
-                if f.startswith('.'):
-                    filelist.remove(f)
+            # the filtered and sorted list of image files is kept
+            self.RefreshFileList()
             self.sizey = 0
             self.sizex = 0
             self.sizec = 1
             self.Npos = 1
-            self.sizet = len(filelist)
+            self.sizet = len(self.filelist)
             
-            for f in filelist:
-                im = skimage.io.imread(os.path.join(self.nd2path , f))
-                if im.ndim==3:
-                    self.sizec = max(self.sizec, im.shape[0])
-                    self.sizey = max(self.sizey, im.shape[1]) #SJR: changed by me
-                    self.sizex = max(self.sizex, im.shape[2]) #SJR: changed by me
-                else:
-                    self.sizey = max(self.sizey, im.shape[0]) #SJR: changed by me
-                    self.sizex = max(self.sizex, im.shape[1]) #SJR: changed by me
+            # the sizes are read from the image headers when possible
+            self.sizec, self.sizey, self.sizex = self._FolderSizes(self.filelist)
 
             self.channel_names = [f'Channel{i}' for i in range(1,self.sizec+1)]
 
@@ -113,11 +117,62 @@ class Reader:
         
         self.default_channel = 0
         self.name = self.hdfpath
+        
+        # handle on the hdf file which is kept open during a session, see
+        # OpenSession/CloseSession
+        self._hdffile = None
+        self._session_depth = 0
                             
         # create an new hfd5 file if no one existing already
         self.Inithdf()
+        
+        # versions of the masks written through this reader, see MaskVersion
+        self.maskversions = {}
+        self.maskgeneration = 0
+        self._maskcounter = 0
+        
+        # index of the time frames which have a mask, for every field of view
+        self.RefreshFrameIndex()
 
         
+    def RefreshFileList(self):
+        """Lists the supported image files of the image folder. The list is 
+        cached, this has to be called again if files were added to the 
+        folder, in which case the number of time frames is updated. Raises
+        a ValueError if the added images are larger than the frames (or have
+        more channels), as the existing masks have the size of the frames."""
+        filelist = list_images(self.nd2path)
+        if hasattr(self, 'tlabels'):
+            known = set(self.filelist)
+            new = [f for f in filelist if f not in known]
+            sizes = (self.sizec, self.sizey, self.sizex)
+            if self._FolderSizes(new, sizes) != sizes:
+                raise ValueError('The new images of the folder do not fit the frames of '
+                                 'size {} (channels, y, x)'.format(sizes))
+            self.filelist = filelist
+            self.sizet = len(self.filelist)
+            for j in range(len(self.tlabels), self.sizet):
+                self.tlabels.append('T'+ str(j))
+        else:
+            self.filelist = filelist
+    
+    
+    def _FolderSizes(self, files, sizes=(1, 0, 0)):
+        """Returns the number of channels, and the size in y and x of the 
+        frames holding the image files of the folder and frames of the 
+        given sizes. Smaller images are padded with zeros when loaded."""
+        sizec, sizey, sizex = sizes
+        for shape in image_shapes([os.path.join(self.nd2path, f) for f in files]):
+            if len(shape)==3:
+                sizec = max(sizec, shape[0])
+                sizey = max(sizey, shape[1]) #SJR: changed by me
+                sizex = max(sizex, shape[2]) #SJR: changed by me
+            else:
+                sizey = max(sizey, shape[0]) #SJR: changed by me
+                sizex = max(sizex, shape[1]) #SJR: changed by me
+        return sizec, sizey, sizex
+    
+    
     def InitLabels(self):
         """Create two lists containing all the possible fields of view and time
         labels, in order to access the arrays in the hdf5 file.
@@ -183,6 +238,59 @@ class Reader:
         hf.close()
 
 
+    def OpenSession(self):
+        """Opens the hdf file and keeps the handle open until CloseSession is
+        called, such that all the mask operations (and the trackers and
+        extractors using them) share one handle instead of reopening the 
+        file for every frame. Sessions can be nested, the file is only closed
+        when the outermost session is closed. Can also be used as a context 
+        manager: `with reader: ...`
+        """
+        if self._hdffile is None:
+            self._hdffile = h5py.File(self.hdfpath, 'r+')
+            log.debug('open hdf session')
+        self._session_depth += 1
+        return self
+    
+    
+    def CloseSession(self):
+        """Closes the session opened with OpenSession. The data is written
+        to the disk when the outermost session is closed."""
+        if self._session_depth == 0:
+            return
+        self._session_depth -= 1
+        if self._session_depth == 0:
+            self._hdffile.close()
+            self._hdffile = None
+            log.debug('close hdf session')
+    
+    
+    def Flush(self):
+        """Writes the buffered data of an open session to the disk, without 
+        closing the handle."""
+        if self._hdffile is not None:
+            self._hdffile.flush()
+    
+    
+    def __enter__(self):
+        return self.OpenSession()
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.CloseSession()
+    
+    
+    @contextmanager
+    def HdfFile(self):
+        """Yields the open hdf file of the current session, or opens the file
+        only for the duration of the with-block if there is no session."""
+        if self._hdffile is not None:
+            yield self._hdffile
+        else:
+            with h5py.File(self.hdfpath, 'r+') as file:
+                yield file
+
+
     def LoadMask(self, currentT, currentFOV):
         """this method is called when one mask should be loaded from the file 
         on the disk to the user's buffer. If there is no mask corresponding
@@ -190,50 +298,69 @@ class Reader:
         field of view index and returns an array filled with zeros.
         """
         
-        file = h5py.File(self.hdfpath,'r+')
-        if self.TestTimeExist(currentT,currentFOV,file):
-            mask = np.array(file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])], dtype = np.uint16)
-            log.debug('load mask')
-            file.close()
+        with self.HdfFile() as file:
+            if self.TestTimeExist(currentT,currentFOV,file):
+                mask = np.array(file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])], dtype = np.uint16)
+                log.debug('load mask')
+                return mask
             
-            return mask
-        
-        else:
-            zeroarray = np.zeros([self.sizey, self.sizex],dtype = np.uint16)
-            file.create_dataset('/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT]), 
-                                data = zeroarray, compression = 'gzip')
-            log.debug('create dataset with zeroarray')
-            file.close()
-            return zeroarray
+            else:
+                zeroarray = np.zeros([self.sizey, self.sizex],dtype = np.uint16)
+                file.create_dataset('/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT]), 
+                                    data = zeroarray, compression = 'gzip')
+                self.frameindex[currentFOV].add(currentT)
+                self._BumpMaskVersion(currentT, currentFOV)
+                log.debug('create dataset with zeroarray')
+                return zeroarray
             
             
+    def RefreshFrameIndex(self):
+        """Builds the in-memory index of the time frames which have a mask in
+        the hdf file, for every field of view. It is kept up to date by 
+        LoadMask and SaveMask, and only has to be refreshed if the file was
+        modified by someone else. The masks are then considered modified, 
+        see MaskVersion."""
+        self.maskgeneration += 1
+        self.frameindex = {i: set() for i in range(self.Npos)}
+        with self.HdfFile() as file:
+            for i in range(self.Npos):
+                if self.fovlabels[i] not in file:
+                    continue
+                for t in file[self.fovlabels[i]].keys():
+                    if t.startswith('T') and t[1:].isdigit():
+                        self.frameindex[i].add(int(t[1:]))
+                        
+                        
+    def ExistingFrames(self, currentFOV):
+        """Returns the sorted list of time indices which have a mask in the 
+        given field of view."""
+        return sorted(t for t in self.frameindex[currentFOV] 
+                      if t < len(self.tlabels))
+    
+    
+    def MaskVersion(self, currentT, currentFOV):
+        """Returns the version of the mask, which changes every time the mask
+        is written through this reader (0 if it was never written). Together
+        with maskgeneration, which changes when the frame index is refreshed,
+        it tells caches of the masks (e.g. the GCN tracker) whether they are
+        still up to date."""
+        return self.maskversions.get((currentFOV, currentT), 0)
+    
+    
+    def _BumpMaskVersion(self, currentT, currentFOV):
+        self._maskcounter += 1
+        self.maskversions[(currentFOV, currentT)] = self._maskcounter
+    
+    
     def TestTimeExist(self, currentT, currentFOV, file=None):
         """This method tests if the array which is requested by LoadMask
         already exists or not in the hdf file.
         
-        If file is None, then it opens the h5py File. Otherwise allows to pass
-        an already open file. 
+        The test is done on the in-memory index of the file (see 
+        RefreshFrameIndex), file is only kept for backwards compatibility.
         """
-        def closefile(f):
-            if file is None:
-                f.close()
-                
-        def openfile(file):
-            if file is None:
-                return h5py.File(self.hdfpath, 'r+')
-            else:
-                return file
-                            
         if currentT <= len(self.tlabels) - 1 and currentT >= 0:
-            f = openfile(file)
-            for t in f['/{}'.format(self.fovlabels[currentFOV])].keys():
-                # currentT is a number
-                # self.tlabels is some string that indexes the time point? E.g., T0?
-                if t == self.tlabels[currentT]:
-                    closefile(f)
-                    return True
-            closefile(f)
-            return False
+            return currentT in self.frameindex[currentFOV]
         else:
             return False
 
@@ -248,20 +375,69 @@ class Reader:
         this save method.
         """
         
-        file = h5py.File(self.hdfpath, 'r+')
+        with self.HdfFile() as file:
+            if self.TestTimeExist(currentT,currentFOV,file):
+                dataset= file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])]
+                dataset[:] = mask
+                log.debug('save mask for FOV {} and frame {} to file'.format(self.fovlabels[currentFOV], self.tlabels[currentT]))
+                
+            else:
+                file.create_dataset('/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT]), data = mask, compression = 'gzip')
+                self.frameindex[currentFOV].add(currentT)
+                log.debug('create dateset and save mask to file')
+            self._BumpMaskVersion(currentT, currentFOV)
         
-        if self.TestTimeExist(currentT,currentFOV,file):
-            dataset= file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])]
-            dataset[:] = mask
-            log.debug('save mask for FOV {} and frame {} to file'.format(self.fovlabels[currentFOV], self.tlabels[currentT]))
-            file.close()
-            
-        else:
-            file.create_dataset('/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT]), data = mask, compression = 'gzip')
-            log.debug('create dateset and save mask to file')
-            file.close()
+        
+    def LoadMaskAttrs(self, currentT, currentFOV):
+        """Returns the attributes recorded with the mask (e.g. how it was 
+        made) as a dict, which is empty if there is no mask."""
+        if not self.TestTimeExist(currentT, currentFOV):
+            return {}
+        with self.HdfFile() as file:
+            dataset = file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])]
+            return dict(dataset.attrs)
         
         
+    def SaveMaskAttrs(self, currentT, currentFOV, attrs):
+        """Replaces the attributes recorded with the mask by the dict attrs,
+        does nothing if there is no mask."""
+        if not self.TestTimeExist(currentT, currentFOV):
+            return
+        with self.HdfFile() as file:
+            dataset = file['/{}/{}'.format(self.fovlabels[currentFOV], self.tlabels[currentT])]
+            dataset.attrs.clear()
+            dataset.attrs.update(attrs)
+        
+        
+    def _ND2Handle(self):
+        """Returns the open ND2Reader of the image file, opens it at the 
+        first call. Has to be called while holding self._imagelock."""
+        if self._nd2 is None:
+            self._nd2 = ND2Reader(self.nd2path)
+        return self._nd2
+    
+    
+    def _TiffHandle(self):
+        """Returns the open TiffStack of the image file, opens it at the 
+        first call."""
+        with self._imagelock:
+            if self._tiff is None:
+                self._tiff = TiffStack(self.nd2path)
+            return self._tiff
+    
+    
+    def CloseImageFile(self):
+        """Closes the handle on the image file. It is reopened automatically
+        at the next image access."""
+        with self._imagelock:
+            if self._nd2 is not None:
+                self._nd2.close()
+                self._nd2 = None
+            if self._tiff is not None:
+                self._tiff.close()
+                self._tiff = None
+    
+    
     def TestIndexRange(self,currentT, currentfov):
         """this method receives the time and the fov index and checks
         if it is present in the images data.
@@ -282,7 +458,8 @@ class Reader:
             return None
         
         if self.isnd2:
-            with ND2Reader(self.nd2path) as images:
+            with self._imagelock:
+                images = self._ND2Handle()
                 try:
                     images.default_coords['v'] = currentfov
                 except ValueError:
@@ -298,7 +475,14 @@ class Reader:
 
                 
         elif self.issingle:
-            full = skimage.io.imread(self.nd2path)
+            if self.istiff:
+                stack = self._TiffHandle()
+                if stack.ndim==3 and not (stack.shape[2] < stack.shape[0] and stack.shape[2] < stack.shape[1]):
+                    # only the requested page is read from the file
+                    return np.array(stack.read(currentT), dtype = np.uint16)
+                full = stack.asarray()
+            else:
+                full = skimage.io.imread(self.nd2path)
             if full.ndim==2:
                 im = full
             elif full.ndim==3:
@@ -312,15 +496,7 @@ class Reader:
 
                                 
         elif self.isfolder:
-            filelist = sorted(os.listdir(self.nd2path))
-            # filter filelist for supported image files
-            filelist = [f for f in filelist if re.search(r".png|.tif|.jpg|.bmp|.jpeg|.pbm|.pgm|.ppm|.pxm|.pnm|.jp2"
-                                                         "|.PNG|.TIF|.JPG|.BMP|.JPEG|.PBM|.PGM|.PPM|.PXM|.PNM|.JP2", f)]
-            for f in filelist:
-                if f.startswith('.'):
-                    filelist.remove(f)
-            
-            im = skimage.io.imread(os.path.join(self.nd2path , filelist[currentT]))
+            im = skimage.io.imread(os.path.join(self.nd2path , self.filelist[currentT]))
             if im.ndim==2:
                 im = np.pad(im,( (0, self.sizey - im.shape[0]) , (0, self.sizex -  im.shape[1] ) ),constant_values=0) # pad with zeros so all images in the same folder have same size
                 outputarray = np.array(im, dtype = np.uint16)
@@ -343,7 +519,8 @@ class Reader:
     def LoadImageChannel(self,currentT, currentFOV, ch):
         """Loads image at specified time, FOV and channel. Only for nd2 files"""
         if self.isnd2:
-            with ND2Reader(self.nd2path) as images:
+            with self._imagelock:
+                images = self._ND2Handle()
                 try:
                     images.default_coords['v'] = currentFOV
                 except ValueError:
@@ -361,3 +538,30 @@ class Reader:
                 
         elif self.isfolder:
             return self.LoadOneImage(currentT, currentFOV,current_channel=ch)
+
+
+    def LoadFrames(self, currentFOV, t_range, channel=None):
+        """Loads the images of the given field of view and channel for all 
+        the time indices in t_range, returns them stacked in an array of 
+        shape (len(t_range), sizey, sizex). For nd2 files the coordinates 
+        are set once and all the planes are read in one pass."""
+        t_range = list(t_range)
+        if self.isnd2:
+            with self._imagelock:
+                images = self._ND2Handle()
+                try:
+                    images.default_coords['v'] = currentFOV
+                except ValueError:
+                    pass
+                try:
+                    images.default_coords['c'] = channel if channel is not None else self.default_channel
+                except ValueError:
+                    pass
+                images.iter_axes = 't'
+                out = np.zeros([len(t_range), self.sizey, self.sizex], dtype = np.uint16)
+                for i, t in enumerate(t_range):
+                    out[i] = images[t]
+                return out
+        
+        return np.array([self.LoadOneImage(t, currentFOV, current_channel=channel) 
+                         for t in t_range], dtype = np.uint16)
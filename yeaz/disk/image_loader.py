@@ -8,9 +8,64 @@ Created on Fri May 15 17:05:00 2020
 
 import os
 import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from skimage import io
+from PIL import Image
 import numpy as np
 
+from .tiff_stack import TiffStack, is_tiff
+
+
+IMAGE_PATTERN = (r".png|.tif|.jpg|.bmp|.jpeg|.pbm|.pgm|.ppm|.pxm|.pnm|.jp2"
+                 "|.PNG|.TIF|.JPG|.BMP|.JPEG|.PBM|.PGM|.PPM|.PXM|.PNM|.JP2")
+
+
+def list_images(path):
+    """Returns the sorted list of the names of the supported image files in 
+    the folder path, hidden files are ignored."""
+    return [f for f in sorted(os.listdir(path)) 
+            if re.search(IMAGE_PATTERN, f) and not f.startswith('.')]
+
+
+def image_shape(path):
+    """Returns the shape of the array that skimage.io.imread would return
+    for the image at path, by only reading the header of the file. Returns
+    None if the shape cannot be read from the header."""
+    try:
+        if is_tiff(path):
+            with TiffStack(path) as stack:
+                shape = tuple(stack.shape)
+        else:
+            with Image.open(path) as im:
+                # palette images are converted when decoded
+                if im.mode == 'P':
+                    return None
+                nbands = len(im.getbands())
+                width, height = im.size
+                shape = (height, width) if nbands == 1 else (height, width, nbands)
+    except Exception:
+        return None
+    # skimage.io.imread moves a leading axis of 3 or 4 planes (e.g. planar 
+    # RGB) to the end
+    if len(shape) > 2 and shape[-1] not in (3, 4) and shape[-3] in (3, 4):
+        shape = shape[:-3] + shape[-2:] + shape[-3:-2]
+    return shape
+
+
+def image_shapes(paths, max_workers=None):
+    """Returns the shapes of the images at paths. The shapes are read from
+    the headers, images for which this is not possible are decoded in 
+    parallel."""
+    shapes = [image_shape(p) for p in paths]
+    todecode = [i for i, shape in enumerate(shapes) if shape is None]
+    if todecode:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            decoded = ex.map(lambda i: io.imread(paths[i]).shape, todecode)
+            for i, shape in zip(todecode, decoded):
+                shapes[i] = shape
+    return shapes
+
 
 def load_image(path, ix=None):
     """Loads Image at specified path. Path can be to single image as supported
@@ -21,10 +76,7 @@ def load_image(path, ix=None):
     
     # Folder
     if ext=='':
-        filelist = sorted(os.listdir(path)) 
-        filelist = [f for f in filelist if 
-                    re.search(r".png|.tif|.jpg|.bmp|.jpeg|.pbm|.pgm|.ppm|.pxm|.pnm|.jp2|.PNG|.TIF|.JPG|.BMP|.JPEG|.PBM|.PGM|.PPM|.PXM|.PNM|.JP2", f)]
-        filelist = [os.path.join(path, f) for f in filelist]
+        filelist = [os.path.join(path, f) for f in list_images(path)]
         
         if len(filelist)==0:
             raise ValueError('Folder does not contain images')
@@ -37,6 +89,15 @@ def load_image(path, ix=None):
             im = io.imread(filelist[ix])
             return im
         
+    # Tiff file, only read the requested page
+    elif ix is not None and is_tiff(path):
+        try:
+            stack = TiffStack(path)
+        except Exception:
+            raise ValueError('Not an image file')
+        with stack:
+            return stack.read(ix)
+        
     # File
     else:
         try:
@@ -57,4 +118,13 @@ def load_image(path, ix=None):
                 return im 
             else: 
                 return im[ix,:,:]
-        
+
+
+def image_hash(im):
+    """Returns a hash of the content of the image array im (values, shape 
+    and dtype), as a hex string"""
+    im = np.ascontiguousarray(im)
+    h = hashlib.blake2b(digest_size=16)
+    h.update('{}{}'.format(im.dtype.str, im.shape).encode())
+    h.update(im.data)
+    return h.hexdigest()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Side store of the predictions of the neural network, such that the frames can
+be segmented again with other parameters (threshold, min. distance between
+seeds) without running the network again.
+
+The predictions are stored as float16 in one hdf file per field of view, in a
+folder next to the mask file. One file per field of view allows the fields of
+view to be segmented by different processes at the same time. The predictions
+are keyed by the weights of the network and the preprocessing of the images,
+such that predictions of other networks are never reused. The hash of the 
+input image and the tiling are stored with every prediction, and the 
+prediction is not reused if the image or the tiling changed. New 
+predictions are segmented before they are rounded, the segmentation of a 
+stored prediction can therefore differ slightly from the first one.
+"""
+
+import os
+import hashlib
+import threading
+import h5py
+import numpy as np
+
+
+def prediction_key(weights_path, preprocessing, precision='float32'):
+    """Returns the key of the predictions made with the weights file
+    weights_path, run in precision, on images preprocessed with 
+    preprocessing (a name). The key changes if the weights file is modified"""
+    weights_path = os.path.abspath(str(weights_path))
+    stat = os.stat(weights_path)
+    h = hashlib.blake2b(digest_size=8)
+    h.update('{}:{}:{}'.format(weights_path, stat.st_mtime_ns, stat.st_size).encode())
+    key = '{}_{}'.format(h.hexdigest(), preprocessing)
+    if precision != 'float32':
+        key = '{}_{}'.format(key, precision)
+    return key
+
+
+def prediction_attrs(input_hash, tile_size=None, tile_overlap=128):
+    """Returns the attributes stored with a prediction of the image whose
+    hash is input_hash (see image_hash), predicted with the given tiling"""
+    tiling = 'none' if tile_size is None else '{}/{}'.format(tile_size, tile_overlap)
+    return {'input_hash': input_hash, 'tiling': tiling}
+
+
+class PredictionCache:
+
+
+    def __init__(self, path):
+        """Opens the store in the folder path, which is created if it does
+        not exist"""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._files = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def PathFor(hdfpath):
+        """Returns the folder of the store for the mask file hdfpath"""
+        return os.path.splitext(hdfpath)[0] + '_predictions'
+
+
+    def _File(self, currentFOV):
+        """Returns the open hdf file of the field of view, has to be called
+        while holding the lock"""
+        if currentFOV not in self._files:
+            self._files[currentFOV] = h5py.File(
+                os.path.join(self.path, 'FOV{}.h5'.format(currentFOV)), 'a')
+        return self._files[currentFOV]
+
+
+    def LoadPrediction(self, currentT, currentFOV, key, attrs=None):
+        """Returns the stored prediction as float32, or None if there is no
+        prediction for the frame and key, or if it was stored with other 
+        attributes than attrs (see prediction_attrs)"""
+        name = '/{}/T{}'.format(key, currentT)
+        with self._lock:
+            file = self._File(currentFOV)
+            if name not in file:
+                return None
+            dataset = file[name]
+            if attrs is not None and any(dataset.attrs.get(k) != v for k, v in attrs.items()):
+                return None
+            return dataset[()].astype(np.float32)
+
+
+    def SavePrediction(self, currentT, currentFOV, key, pred, attrs=None):
+        """Stores the prediction, rounded to float16, with the attributes 
+        attrs (see prediction_attrs)"""
+        name = '/{}/T{}'.format(key, currentT)
+        pred = np.asarray(pred, dtype=np.float16)
+        with self._lock:
+            file = self._File(currentFOV)
+            if name in file and file[name].shape == pred.shape:
+                file[name][...] = pred
+            else:
+                if name in file:
+                    del file[name]
+                file.create_dataset(name, data=pred, compression='gzip')
+            file[name].attrs.clear()
+            if attrs is not None:
+                file[name].attrs.update(attrs)
+
+
+    def Close(self):
+        with self._lock:
+            for file in self._files.values():
+                file.close()
+            self._files = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
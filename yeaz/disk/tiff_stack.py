@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Random access to the frames of (multi-page) tiff files.
+
+Only the requested frame is read from the disk: uncompressed files are
+memory-mapped, otherwise only the page of the frame is decoded. Files which
+store the whole stack in a single page are decoded once and kept in memory.
+"""
+
+import os
+import threading
+import numpy as np
+import tifffile
+
+
+TIFF_EXTENSIONS = ['.tif', '.tiff', '.TIF', '.TIFF']
+
+
+def is_tiff(path):
+    """Tests if path is a tiff file, based on its extension"""
+    _, ext = os.path.splitext(path)
+    return ext in TIFF_EXTENSIONS
+
+
+class TiffStack:
+
+
+    def __init__(self, path):
+        """Opens the tiff file and reads the shape of the stored image data
+        from the header, without decoding the image data."""
+        self.path = path
+        self._lock = threading.Lock()
+        self._tif = tifffile.TiffFile(path)
+        self._series = self._tif.series[0]
+        self.shape = tuple(self._series.shape)
+        self.dtype = self._series.dtype
+        self.ndim = len(self.shape)
+
+        # memory-map the data if it is stored uncompressed and contiguous
+        try:
+            self._memmap = tifffile.memmap(path, mode='r')
+        except ValueError:
+            self._memmap = None
+
+        # the frames can be decoded page by page
+        self._paged = (self.ndim == 3
+                       and len(self._series.pages) == self.shape[0])
+        self._full = None
+
+
+    def __len__(self):
+        """Number of frames along the first axis (1 for a 2D image)"""
+        return 1 if self.ndim == 2 else self.shape[0]
+
+
+    def read(self, ix=None):
+        """Returns the frame ix along the first axis of the stack. If ix is
+        None or the image is 2D, the whole image data is returned."""
+        if ix is None or self.ndim == 2:
+            return self.asarray()
+        if self._memmap is not None:
+            return np.array(self._memmap[ix])
+        with self._lock:
+            if self._paged:
+                return self._series.pages[ix].asarray()
+            return self._load_full()[ix]
+
+
+    def asarray(self):
+        """Returns the whole image data"""
+        if self._memmap is not None:
+            return np.array(self._memmap)
+        with self._lock:
+            return self._load_full().copy()
+
+
+    def _load_full(self):
+        """Decodes the whole image data once, has to be called while holding
+        the lock"""
+        if self._full is None:
+            self._full = self._series.asarray()
+        return self._full
+
+
+    def close(self):
+        self._memmap = None
+        self._full = None
+        self._tif.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
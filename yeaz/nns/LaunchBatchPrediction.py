@@ -64,12 +64,22 @@ class CustomDialog(QDialog):
         self.device_selection.setCurrentIndex(0)
         flo.addRow("Select device for running neural network: ", self.device_selection)
         
+        self.precision = QComboBox()
+        self.precision.addItem("float32", "float32")
+        self.precision.addItem("bfloat16 (faster on recent CPUs, slightly different results)", "bfloat16")
+        self.precision.setCurrentIndex(0)
+        flo.addRow("Select precision of the neural network: ", self.precision)
+        
         self.tracker = QComboBox()
         self.tracker.addItem("old-fashion but fast, Hungarian algorithm","Hungarian")
         self.tracker.addItem ("new-fashion but slower if you have a lot of cells, Graph Convolutional Network","GCN",)
         self.tracker.setCurrentIndex(0)
         flo.addRow("Select the algorithm for tracking cells: ", self.tracker)
         
+        self.reuse_predictions = QCheckBox("Store the predictions of the neural network and reuse them when segmenting again")
+        self.reuse_predictions.setChecked(False)
+        flo.addRow(self.reuse_predictions)
+        
         QBtn = QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel
         
         self.buttonBox = QDialogButtonBox(QBtn)
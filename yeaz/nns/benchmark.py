@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the processing steps, which also check that the optimized
+implementations give the same results as the reference ones.
+
+Run:
+
+python -m yeaz.nns.benchmark -i example_data/2020_3_19_frame_100_cropped.tif
+
+With --precision, the inference in reduced precision is also compared to
+float32 and the script exits with an error if the segmentations differ more
+than allowed by --min_iou.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import skimage.exposure
+
+from yeaz.disk.image_loader import load_image
+from yeaz.nns import preprocessing
+from yeaz.nns import neural_network as nn
+from yeaz.nns.segment import segment_prediction
+
+
+def load_frames(path, n_frames=None):
+    """Returns the list of the 2D frames of the image file or folder path,
+    only the first n_frames if given"""
+    ims = load_image(path)
+    if ims.ndim == 2:
+        ims = ims[np.newaxis]
+    # num pages should be smaller than x or y dimension
+    elif ims.shape[2] < ims.shape[0] and ims.shape[2] < ims.shape[1]:
+        ims = np.moveaxis(ims, -1, 0)
+    return list(ims[:n_frames])
+
+
+def time_function(f, repeat=3):
+    """Returns the result of f() and the best time in seconds of repeat
+    calls"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = f()
+        best = min(best, time.perf_counter() - start)
+    return res, best
+
+
+def benchmark_preprocessing(frames, repeat=3, n_workers=None):
+    """
+    Compares the preprocessing of the frames with preprocessing.equalize_adapthist
+    and with skimage.exposure.equalize_adapthist (converted to float32).
+    Returns a dict with the times in seconds per frame and the maximal
+    absolute difference of the results.
+    """
+    ref, t_ref = time_function(
+        lambda: [skimage.exposure.equalize_adapthist(im).astype(np.float32) for im in frames], repeat)
+    res, t_res = time_function(
+        lambda: [preprocessing.equalize_adapthist(im) for im in frames], repeat)
+    _, t_batch = time_function(
+        lambda: preprocessing.equalize_adapthist_batch(frames, n_workers=n_workers), repeat)
+
+    return {'skimage': t_ref / len(frames),
+            'preprocessing': t_res / len(frames),
+            'preprocessing_batch': t_batch / len(frames),
+            'max_abs_diff': max(float(np.abs(r - s).max()) for r, s in zip(ref, res))}
+
+
+def foreground_iou(mask1, mask2):
+    """Returns the intersection over union of the cells (non-zero pixels) of
+    the two masks"""
+    fg1, fg2 = mask1 > 0, mask2 > 0
+    union = np.count_nonzero(fg1 | fg2)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(fg1 & fg2) / union
+
+
+def benchmark_inference(frames, mic_type, pretrained_weights=None, device=None,
+                        precision='bfloat16', batch_size=4, repeat=3, 
+                        thr_val=None, min_distance=10):
+    """
+    Compares the inference in float32 and in precision on the preprocessed
+    frames. Returns a dict with the times in seconds per frame, the maximal
+    absolute difference of the probabilities and the minimal foreground IoU
+    of the segmentations of the frames.
+    """
+    ims = preprocessing.equalize_adapthist_batch(frames)
+    for prec in ('float32', precision):  # load once, not timed
+        nn.get_model(mic_type, pretrained_weights, device, prec)
+
+    def run(prec):
+        return [nn.predict_batch(ims[i:i+batch_size], mic_type, pretrained_weights, 
+                                 device=device, batch_size=batch_size, precision=prec)
+                for i in range(0, len(ims), batch_size)]
+
+    ref, t_ref = time_function(lambda: np.concatenate(run('float32')), repeat)
+    res, t_res = time_function(lambda: np.concatenate(run(precision)), repeat)
+
+    ious = [foreground_iou(segment_prediction(r, thr_val, min_distance),
+                           segment_prediction(p, thr_val, min_distance))
+            for r, p in zip(ref, res)]
+
+    return {'float32': t_ref / len(frames),
+            precision: t_res / len(frames),
+            'max_abs_diff': float(np.abs(ref - res).max()),
+            'min_iou': min(ious)}
+
+
+def main(args):
+    frames = load_frames(args.image_path, args.frames)
+    print('{} frames of shape {}'.format(len(frames), frames[0].shape))
+
+    res = benchmark_preprocessing(frames, args.repeat, args.workers)
+    print('CLAHE preprocessing (s/frame): skimage {:.4f}, preprocessing {:.4f}, batched {:.4f}'.format(
+        res['skimage'], res['preprocessing'], res['preprocessing_batch']))
+    print('    max. abs. difference: {:.3g}'.format(res['max_abs_diff']))
+
+    if args.precision is None or args.precision == 'float32':
+        return 0
+    
+    res = benchmark_inference(frames, args.image_type, args.path_to_weights, args.device,
+                              args.precision, args.batch_size, args.repeat)
+    print('Inference (s/frame): float32 {:.4f}, {} {:.4f}'.format(
+        res['float32'], args.precision, res[args.precision]))
+    print('    max. abs. difference of the probabilities: {:.3g}'.format(res['max_abs_diff']))
+    print('    min. foreground IoU of the segmentations: {:.4f}'.format(res['min_iou']))
+    if res['min_iou'] < args.min_iou:
+        print('Error: the IoU is below {}'.format(args.min_iou))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--image_path', type=str, help="Specify the path to a single image or to a folder of images", required=True)
+    parser.add_argument('--frames', default=None, type=int, help="Specify maximal number of frames to use.")
+    parser.add_argument('--repeat', default=3, type=int, help="Specify number of repetitions, the best time is reported.")
+    parser.add_argument('--workers', default=None, type=int, help="Specify number of threads for the batched preprocessing.")
+    parser.add_argument('--precision', default=None, type=str, choices=nn.PRECISIONS, help="Specify reduced precision of the inference to compare to float32.")
+    parser.add_argument('--image_type', default='pc', type=str, help="Specify the imaging type, possible 'bf' and 'pc'.")
+    parser.add_argument('--path_to_weights', default=None, type=str, help="Specify weights path.")
+    parser.add_argument('--device', default='cpu', type=str, help="Device to run the neural network on, 'cpu' or 'cuda'.")
+    parser.add_argument('--batch_size', default=4, type=int, help="Specify number of images passed at once through the network.")
+    parser.add_argument('--min_iou', default=0.98, type=float, help="Specify minimal foreground IoU of the segmentations in reduced precision.")
+    args = parser.parse_args()
+    sys.exit(main(args))
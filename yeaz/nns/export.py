@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exports the weights of the neural network as frozen TorchScript models, which
+are then used instead of the weights on the CPU in float32, see 
+neural_network.export_model.
+
+Run:
+
+python -m yeaz.nns.export
+
+to export all the bundled weights, or with --path_to_weights to export a 
+custom weights file. The models have to be exported again if the weights are
+modified, until then the weights are used.
+"""
+
+import argparse
+import os
+import sys
+
+from yeaz.nns import neural_network as nn
+
+
+def main(args):
+    if args.path_to_weights is not None:
+        weights = {args.path_to_weights: None}
+    else:
+        weights = {nn.get_weights_path(mic_type): mic_type for mic_type in ['pc', 'bf', 'fission']}
+    
+    exported = 0
+    for path, mic_type in weights.items():
+        if not os.path.exists(str(path)):
+            print('Skipping {}, the weights file does not exist'.format(path))
+            continue
+        print('Exported {}'.format(nn.export_model(mic_type, path)))
+        exported += 1
+    return 0 if exported > 0 else 1
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_weights', default=None, type=str, help="Specify weights path, by default all the bundled weights are exported.")
+    args = parser.parse_args()
+    sys.exit(main(args))
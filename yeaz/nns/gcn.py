@@ -1,5 +1,9 @@
+import os
 import tqdm
 import json
+import tempfile
+import threading
+import weakref
 from pathlib import Path
 import h5py
 import numpy as np
@@ -7,6 +11,8 @@ from bread.algo import tracking
 from bread.data import SegmentationFile, Features, Segmentation
 import logging
 
+from .labels import resolve_new_cells, remap_labels
+
 
 import importlib.resources as resources
 # Access weight file
@@ -15,11 +21,30 @@ path_weights = resources.files('yeaz.nns.weights')
 
 log = logging.getLogger(__name__)
 
-def start_tracking_fission(reader, fov_ind, time_value1, time_value2):
-    seg = SegmentationFile.from_h5(reader.hdfpath, small_particle_threshold = 64).get_segmentation(f'FOV{fov_ind}')
-    feat = Features(seg, nn_threshold=12)
-    
-    model_path = path_weights / 'fission_tracking/2024-01-31_15_07_49'
+# weights of the trackers and the arguments with which the masks are loaded
+# by SegmentationFile.from_h5
+TRACKERS = {
+    'budding': ('budding_tracking_features_2023-12-25_12_21_17', {}),
+    'fission': ('fission_tracking/2024-01-31_15_07_49', {'small_particle_threshold': 64}),
+}
+
+
+# trackers which are already loaded, keyed by type, see get_tracker
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(type='budding'):
+    """Returns the GCN tracker for the cell type ('budding' or 'fission'), 
+    it is only loaded the first time and reused by the following calls"""
+    with _trackers_lock:
+        if type not in _trackers:
+            _trackers[type] = load_tracker(path_weights / TRACKERS[type][0])
+        return _trackers[type]
+
+
+def load_tracker(model_path):
+    """Loads the GCN tracker saved in the folder model_path"""
     print('model_path: ' , str(model_path))
     with open(model_path / 'hyperparams.json') as file:
         hparams = json.load(file)
@@ -38,168 +63,239 @@ def start_tracking_fission(reader, fov_ind, time_value1, time_value2):
     ).initialize()
     GCNTracker.load_params(model_path / 'params.pt')
     GCNTracker.module_.train(False)
-    for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with GCN', leave=True):   
-        # apply tracker if wanted and if not at first time
-        try:
-            temp_mask = CellCorrespondenceGCN(reader, GCNTracker, seg, feat, t, fov_ind, type='fission')
-            feat.replace_frame_in_segmentation(t, temp_mask)
-            reader.SaveMask(t, fov_ind, temp_mask)
-        except Exception as e:
-            print(f'Exception happened at start_tracking_fission: {e}, time: {time_value1} to {time_value2}')
-            break
+    return GCNTracker
+
+
+class _FeaturesEntry:
+    """Segmentation and Features of a field of view, with the versions of 
+    the masks of the reader they were built from"""
     
-def start_tracking(reader, fov_ind, time_value1, time_value2):
-    seg = SegmentationFile.from_h5(reader.hdfpath).get_segmentation(f'FOV{fov_ind}')
-    feat = Features(seg, nn_threshold=12)
+    def __init__(self, reader, seg, feat, frames, versions):
+        self.reader = weakref.ref(reader)
+        self.generation = reader.maskgeneration
+        self.seg = seg
+        self.feat = feat
+        self.frames = frames
+        self.versions = versions
+
+
+# features of the last tracked fields of view, keyed by 
+# (hdf path, field of view, type), see get_features
+_features = {}
+_features_lock = threading.Lock()
+_MAX_FEATURES = 2
+
+
+def _mask_versions(reader, fov_ind, frames):
+    return {t: reader.MaskVersion(t, fov_ind) for t in frames}
+
+
+def get_features(reader, fov_ind, type='budding'):
+    """
+    Returns the segmentation of the field of view and its Features, as used 
+    by the GCN tracker. They are kept for the following calls with the same 
+    reader, such that tracking a few frames again does not load and compute
+    the features of the whole field of view: only the frames whose mask was
+    written through the reader since are replaced. Everything is built again
+    if masks were added or the frame index of the reader was refreshed.
     
-    model_path = path_weights / 'budding_tracking_features_2023-12-25_12_21_17'
-    print('model_path: ' , str(model_path))
-    with open(model_path / 'hyperparams.json') as file:
-        hparams = json.load(file)
+    Replacing a frame with Features.replace_frame_in_segmentation has to
+    change the returned segmentation too, as CellCorrespondenceGCN reads the
+    masks from it. The features are therefore only kept if they hold the 
+    segmentation itself and not a copy.
+    """
+    key = (os.path.abspath(reader.hdfpath), fov_ind, type)
+    frames = reader.ExistingFrames(fov_ind)
+    versions = _mask_versions(reader, fov_ind, frames)
+    
+    with _features_lock:
+        entry = _features.pop(key, None)
+        if (entry is None or entry.reader() is not reader 
+            or entry.generation != reader.maskgeneration or entry.frames != frames):
+            reader.Flush()
+            seg = SegmentationFile.from_h5(reader.hdfpath, **TRACKERS[type][1]).get_segmentation(f'FOV{fov_ind}')
+            entry = _FeaturesEntry(reader, seg, Features(seg, nn_threshold=12), frames, versions)
+        else:
+            changed = [t for t in frames if entry.versions[t] != versions[t]]
+            if changed:
+                for t, mask in zip(changed, _load_segmentation_frames(reader, fov_ind, changed, type)):
+                    entry.feat.replace_frame_in_segmentation(t, mask)
+                entry.versions = versions
+        
+        if getattr(entry.feat, 'segmentation', None) is not entry.seg:
+            return entry.seg, entry.feat
+        _features[key] = entry
+        while len(_features) > _MAX_FEATURES:
+            del _features[next(iter(_features))]
+        return entry.seg, entry.feat
 
-    # first initialize the model
-    GCNTracker = tracking.AssignmentClassifier(
-        tracking.GNNTracker,
-        module__num_node_attr=hparams['num_node_attr'],
-        module__num_edge_attr=hparams['num_edge_attr'],
-        module__dropout_rate=hparams['dropout_rate'],
-        module__encoder_hidden_channels=hparams['encoder_hidden_channels'],
-        module__encoder_num_layers=hparams['encoder_num_layers'],
-        module__conv_hidden_channels=hparams['conv_hidden_channels'],
-        module__conv_num_layers=hparams['conv_num_layers'],
-        module__num_classes=1,
-    ).initialize()
-    GCNTracker.load_params(model_path / 'params.pt')
-    GCNTracker.module_.train(False)
-    for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with GCN', leave=True):   
-        # apply tracker if wanted and if not at first time
-        try:
-            temp_mask = CellCorrespondenceGCN(reader, GCNTracker, seg, feat, t, fov_ind, type = 'budding')
-            feat.replace_frame_in_segmentation(t, temp_mask)
-            reader.SaveMask(t, fov_ind, temp_mask)
-        except Exception as e:
-            print(e)
-            break
+
+def _sync_features(reader, fov_ind, type='budding'):
+    """Records that the features of the field of view are up to date with 
+    the masks written by the tracker"""
+    key = (os.path.abspath(reader.hdfpath), fov_ind, type)
+    with _features_lock:
+        entry = _features.get(key)
+        if entry is not None and entry.reader() is reader:
+            entry.versions = _mask_versions(reader, fov_ind, entry.frames)
+
+
+def _load_segmentation_frames(reader, fov_ind, frames, type='budding'):
+    """Returns the masks of the frames as loaded by SegmentationFile.from_h5 
+    (e.g. without the small particles for fission), read from a temporary 
+    hdf file which only holds these frames"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'frames.h5')
+        with h5py.File(path, 'w') as file:
+            group = file.create_group(f'FOV{fov_ind}')
+            for i, t in enumerate(frames):
+                group.create_dataset(f'T{i}', data=reader.LoadMask(t, fov_ind))
+        seg = SegmentationFile.from_h5(path, **TRACKERS[type][1]).get_segmentation(f'FOV{fov_ind}')
+        return [np.array(seg[i]) for i in range(len(frames))]
+
+
+def start_tracking_fission(reader, fov_ind, time_value1, time_value2):
+    GCNTracker = get_tracker('fission')
+    with reader:
+        seg, feat = get_features(reader, fov_ind, 'fission')
+        for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with GCN', leave=True):   
+            # apply tracker if wanted and if not at first time
+            try:
+                temp_mask = CellCorrespondenceGCN(reader, GCNTracker, seg, feat, t, fov_ind, type='fission')
+                feat.replace_frame_in_segmentation(t, temp_mask)
+                reader.SaveMask(t, fov_ind, temp_mask)
+            except Exception as e:
+                print(f'Exception happened at start_tracking_fission: {e}, time: {time_value1} to {time_value2}')
+                break
+        _sync_features(reader, fov_ind, 'fission')
+    
+def start_tracking(reader, fov_ind, time_value1, time_value2):
+    GCNTracker = get_tracker('budding')
+    with reader:
+        seg, feat = get_features(reader, fov_ind, 'budding')
+        for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with GCN', leave=True):   
+            # apply tracker if wanted and if not at first time
+            try:
+                temp_mask = CellCorrespondenceGCN(reader, GCNTracker, seg, feat, t, fov_ind, type = 'budding')
+                feat.replace_frame_in_segmentation(t, temp_mask)
+                reader.SaveMask(t, fov_ind, temp_mask)
+            except Exception as e:
+                print(e)
+                break
+        _sync_features(reader, fov_ind, 'budding')
     
     
 def CellCorrespondenceGCN(reader,GCNTracker, seg, feat, currentT, currentFOV, type='budding'):
     
-    filemasks = h5py.File(reader.hdfpath, 'r+')
+    with reader.HdfFile() as filemasks:
     
-    if reader.TestTimeExist(currentT-1, currentFOV, filemasks):
-        # prevmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV], 
-        #                                                 reader.tlabels[currentT-1])])
-        prevmask = seg[currentT-1]
+        if reader.TestTimeExist(currentT-1, currentFOV, filemasks):
+            # prevmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV], 
+            #                                                 reader.tlabels[currentT-1])])
+            prevmask = seg[currentT-1]
         
-        # A mask exists for both time frames
-        if reader.TestTimeExist(currentT, currentFOV, filemasks):
+            # A mask exists for both time frames
+            if reader.TestTimeExist(currentT, currentFOV, filemasks):
             
-            # nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
-            #                                                 reader.tlabels[currentT])])
+                # nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
+                #                                                 reader.tlabels[currentT])])
             
-            nextmask = seg[currentT]
+                nextmask = seg[currentT]
             
-            # test if prevmash and nextmask both have only one cell
+                # test if prevmash and nextmask both have only one cell
             
-            if len(np.unique(prevmask)) == 2 or len(np.unique(nextmask)) == 2:
-                print('Only one cell in prevmask or nextmask, returning nextmask')
-                return nextmask
+                if len(np.unique(prevmask)) == 2 or len(np.unique(nextmask)) == 2:
+                    print('Only one cell in prevmask or nextmask, returning nextmask')
+                    return nextmask
             
-            if type == 'budding':
-                # run gcn
-                cell_features = [
-                    "area", 
-                    "r_equiv", 
-                    "r_maj", 
-                    "r_min", 
-                    "angel", 
-                    "ecc", 
-                    "maj_x", 
-                    "maj_y", 
-                    "min_x", 
-                    "min_y"
-                ]
-            elif type == 'fission':
-                cell_features = [
-                    'area',
-                    'r_equiv',
-                    'r_maj',
-                    'r_min',
-                    'angel',
-                    'ecc',
-                    'maj_x',
-                    'maj_y',
-                    'min_x',
-                    'min_y',
-                    'x',
-                    'y',
-                ]
-            else:
-                print('unsupported cell type')
+                if type == 'budding':
+                    # run gcn
+                    cell_features = [
+                        "area", 
+                        "r_equiv", 
+                        "r_maj", 
+                        "r_min", 
+                        "angel", 
+                        "ecc", 
+                        "maj_x", 
+                        "maj_y", 
+                        "min_x", 
+                        "min_y"
+                    ]
+                elif type == 'fission':
+                    cell_features = [
+                        'area',
+                        'r_equiv',
+                        'r_maj',
+                        'r_min',
+                        'angel',
+                        'ecc',
+                        'maj_x',
+                        'maj_y',
+                        'min_x',
+                        'min_y',
+                        'x',
+                        'y',
+                    ]
+                else:
+                    print('unsupported cell type')
             
-            edge_features = [
-                "cmtocm_x",
-                "cmtocm_y",
-                "cmtocm_len",
-                "cmtocm_angle",
-                "contour_dist",
-            ]
-            # Make graphs
-            try:
-                ga = tracking.build_assgraph(
-                    tracking.build_cellgraph(
-                        feat,
-                        currentT-1,
-                        cell_features=cell_features,
-                        edge_features=edge_features,
-                    ),
-                    tracking.build_cellgraph(
-                        feat,
-                        currentT,
-                        cell_features=cell_features,
-                        edge_features=edge_features,
-                    ),
-                    include_target_feature=True)
+                edge_features = [
+                    "cmtocm_x",
+                    "cmtocm_y",
+                    "cmtocm_len",
+                    "cmtocm_angle",
+                    "contour_dist",
+                ]
+                # Make graphs
+                try:
+                    ga = tracking.build_assgraph(
+                        tracking.build_cellgraph(
+                            feat,
+                            currentT-1,
+                            cell_features=cell_features,
+                            edge_features=edge_features,
+                        ),
+                        tracking.build_cellgraph(
+                            feat,
+                            currentT,
+                            cell_features=cell_features,
+                            edge_features=edge_features,
+                        ),
+                        include_target_feature=True)
                     
-                gat, *_ = tracking.to_data(ga)
+                    gat, *_ = tracking.to_data(ga)
                 
-                # prediction of trakcing
-                assignment_method = "hungarian" if type == "budding" else "custom_optimizer"
+                    # prediction of trakcing
+                    assignment_method = "hungarian" if type == "budding" else "custom_optimizer"
 
-                assignments_dict = GCNTracker.predict_assignment(gat, assignment_method=assignment_method, return_dict=True)
+                    assignments_dict = GCNTracker.predict_assignment(gat, assignment_method=assignment_method, return_dict=True)
                 
-                # make the output mask using this assignment
-                out = nextmask.copy()
-                newcell = np.max(prevmask) + 1
-                for key, val in assignments_dict.items():
-                    # If new cell
-                    if val == -1:
-                        val = newcell
-                        newcell += 1
-                    
-                    out[nextmask==key] = val
-            except Exception as e:
-                print(f'Error in tracking with GCN for frame {currentT+1}: {e} /n returning unchanged mask')
-                out = nextmask
+                    # make the output mask using this assignment
+                    newcell = np.max(prevmask) + 1
+                    out = remap_labels(nextmask, resolve_new_cells(assignments_dict, newcell))
+                except Exception as e:
+                    print(f'Error in tracking with GCN for frame {currentT+1}: {e} /n returning unchanged mask')
+                    out = nextmask
                         
-        # No mask exists for the current timeframe, return empty array
-        else:
-            null = np.zeros([reader.sizey, reader.sizex])
-            log.warn('No mask exists in FOV {} for the current timeframe {}, return empty array'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
-            out = null
+            # No mask exists for the current timeframe, return empty array
+            else:
+                null = np.zeros([reader.sizey, reader.sizex])
+                log.warn('No mask exists in FOV {} for the current timeframe {}, return empty array'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
+                out = null
     
-    else:
-        # Current mask exists, but no previous - returns current mask unchanged
-        if reader.TestTimeExist(currentT, currentFOV, filemasks):
-            nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
-                                                            reader.tlabels[currentT])]) 
-            out = nextmask
-            log.warn('NCurrent mask exists, but no previous - returns current mask unchanged. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
-        # Neither current nor previous mask exists - return empty array
         else:
-            log.warn('Neither current nor previous mask exists - return empty array. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
-            null = np.zeros([reader.sizey, reader.sizex])
-            out = null
+            # Current mask exists, but no previous - returns current mask unchanged
+            if reader.TestTimeExist(currentT, currentFOV, filemasks):
+                nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
+                                                                reader.tlabels[currentT])]) 
+                out = nextmask
+                log.warn('NCurrent mask exists, but no previous - returns current mask unchanged. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
+            # Neither current nor previous mask exists - return empty array
+            else:
+                log.warn('Neither current nor previous mask exists - return empty array. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
+                null = np.zeros([reader.sizey, reader.sizex])
+                out = null
                 
-    filemasks.close()
     return out
+
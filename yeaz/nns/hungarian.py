@@ -1,42 +1,99 @@
 import numpy as np
-import pandas as pd
 from munkres import Munkres
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 import tqdm
-from sklearn.preprocessing import scale
-from sklearn.metrics.pairwise import euclidean_distances
 import logging
-import h5py
+
+from .labels import resolve_new_cells, remap_labels
 
 log = logging.getLogger(__name__)
 
+# solvers of the assignment problem: scipy's compiled rectangular solver, or
+# the pure python munkres package on the cost matrix padded to a square
+SOLVERS = ['scipy', 'munkres']
+
 
-def start_tracking(reader, fov_ind, time_value1, time_value2):
-    for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with Hungarian', leave=True):  
+def start_tracking(reader, fov_ind, time_value1, time_value2, solver='scipy', max_dist=None,
+                   write_batch=16):
+    """Tracks the frames time_value1 to time_value2 of the field of view, 
+    see correspondence for solver and max_dist. Every mask is only read once:
+    the tracked mask of the previous frame and its features are kept in 
+    memory for the next frame, and the tracked masks are written 
+    write_batch frames at a time."""
+    with reader:
+        prevmask = ReadMask(reader, time_value1-1, fov_ind)
+        # features of the tracked mask of the previous frame
+        features = None
+        pending = []
+        
+        def write():
+            for t, mask in pending:
+                reader.SaveMask(t, fov_ind, mask)
+            pending.clear()
+        
+        for t in tqdm.tqdm(range(time_value1, time_value2+1), desc='Tracking frames with Hungarian', leave=True):  
+            try:
+                # apply tracker if wanted and if not at first time
+                nextmask = ReadMask(reader, t, fov_ind)
+                temp_mask, features = TrackMask(reader, t, fov_ind, prevmask, nextmask, features,
+                                                solver=solver, max_dist=max_dist)
+                pending.append((t, temp_mask))
+                prevmask = temp_mask
+                if len(pending) >= write_batch:
+                    write()
+            except Exception as e:
+                print(e)
+                break
         try:
-            # apply tracker if wanted and if not at first time
-            temp_mask = CellCorrespondence(reader, t, fov_ind)
-            reader.SaveMask(t, fov_ind, temp_mask)
+            write()
         except Exception as e:
             print(e)
-            break
 
-def CellCorrespondence(reader, currentT, currentFOV):
+
+def ReadMask(reader, currentT, currentFOV):
+    """Returns the mask of the frame as stored in the hdf file, or None if 
+    there is no mask"""
+    if not reader.TestTimeExist(currentT, currentFOV):
+        return None
+    with reader.HdfFile() as filemasks:
+        return np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV], 
+                                                  reader.tlabels[currentT])])
+
+
+def CellCorrespondence(reader, currentT, currentFOV, prev_features=None, return_features=False,
+                       solver='scipy', max_dist=None):
     """Performs tracking, handles loading of the images. If the image to 
     track has no precedent, returns unaltered mask. If no mask exists
-    for the current timeframe, returns zero array."""
-    filemasks = h5py.File(reader.hdfpath, 'r+')
+    for the current timeframe, returns zero array. prev_features are the
+    features (see cell_features) of the mask of the previous frame if already
+    known. If return_features, the features of the returned mask are also 
+    returned, to be passed as prev_features for the next frame. See 
+    correspondence for solver and max_dist."""
     log.debug('Reader.CellCorrespondence')
     
-    if reader.TestTimeExist(currentT-1, currentFOV, filemasks):
-        prevmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV], 
-                                                        reader.tlabels[currentT-1])])
+    out, features = TrackMask(reader, currentT, currentFOV, 
+                              ReadMask(reader, currentT-1, currentFOV),
+                              ReadMask(reader, currentT, currentFOV), 
+                              prev_features, solver=solver, max_dist=max_dist)
+    if return_features:
+        return out, features
+    return out
+
+
+def TrackMask(reader, currentT, currentFOV, prevmask, nextmask, prev_features=None,
+              solver='scipy', max_dist=None):
+    """Tracks the mask nextmask of the frame currentT from the (tracked) mask 
+    prevmask of the previous frame, see CellCorrespondence. The masks are 
+    None if they do not exist. Returns the tracked mask and its features."""
+    if prevmask is not None:
         # A mask exists for both time frames
-        if reader.TestTimeExist(currentT, currentFOV, filemasks):
-            nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
-                                                            reader.tlabels[currentT])])             
-            newmask = correspondence(prevmask, nextmask)
-            out = newmask
+        if nextmask is not None:
+            out, features = correspondence(prevmask, nextmask, prev_features, 
+                                           return_features=True, solver=solver,
+                                           max_dist=max_dist)
             log.debug('make new mask')
+            return out, features
         # No mask exists for the current timeframe, return empty array
         else:
             null = np.zeros([reader.sizey, reader.sizex])
@@ -45,9 +102,7 @@ def CellCorrespondence(reader, currentT, currentFOV):
     
     else:
         # Current mask exists, but no previous - returns current mask unchanged
-        if reader.TestTimeExist(currentT, currentFOV, filemasks):
-            nextmask = np.array(filemasks['/{}/{}'.format(reader.fovlabels[currentFOV],
-                                                            reader.tlabels[currentT])]) 
+        if nextmask is not None:
             out = nextmask
             log.warn('NCurrent mask exists, but no previous - returns current mask unchanged. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
         # Neither current nor previous mask exists - return empty array
@@ -55,11 +110,12 @@ def CellCorrespondence(reader, currentT, currentFOV):
             log.warn('Neither current nor previous mask exists - return empty array. FOV {} and Time {}'.format(reader.fovlabels[currentFOV],reader.tlabels[currentT-1]))
             null = np.zeros([reader.sizey, reader.sizex])
             out = null
-                
-    filemasks.close()
-    return out
+    
+    return out, cell_features(out)
 
-def correspondence(prev, curr):
+
+def correspondence(prev, curr, prev_features=None, return_features=False, solver='scipy',
+                   max_dist=None):
     """
     Corrects correspondence between previous and current mask, returns current
     mask with corrected cell values. New cells are given the unique identifier
@@ -69,43 +125,66 @@ def correspondence(prev, curr):
     the center of mass and the area. The pairwise euclidean distance is 
     calculated between the cells of the previous and current frame. This is 
     then used as a cost for the bipartite matching problem which is in turn
-    solved by the Hungarian algorithm as implemented in the munkres package.
+    solved by the Hungarian algorithm, with scipy's linear_sum_assignment or
+    as implemented in the munkres package (solver). If max_dist is given, 
+    only the cells whose centers of mass are at most max_dist pixels apart 
+    can be matched, the others are new cells.
+    
+    prev_features are the features of prev (see cell_features) if already
+    known. If return_features, the features of the returned mask are also 
+    returned, such that they can be passed as prev_features for the next 
+    frame and each frame is only processed once.
     """
     newcell = np.max(prev) + 1
     
-    hu_dict = hungarian_align(prev, curr)
-    new = curr.copy()
-    for key, val in hu_dict.items():
-        # If new cell
-        if val == -1:
-            val = newcell
-            newcell += 1
-        
-        new[curr==key] = val
-        
+    curr_features = cell_features(curr)
+    hu_dict = hungarian_align(prev, curr, prev_features, curr_features, solver, max_dist)
+    hu_dict = resolve_new_cells(hu_dict, newcell)
+    new = remap_labels(curr, hu_dict)
+    
+    if return_features:
+        cells, features = curr_features
+        cells = np.array([hu_dict.get(c, c) for c in cells], dtype=cells.dtype)
+        return new, (cells, features)
     return new
 
 
-def hungarian_align(m1, m2):
+def hungarian_align(m1, m2, features1=None, features2=None, solver='scipy', max_dist=None):
     """
     Aligns the cells using the hungarian algorithm using the euclidean distance as 
-    cost. 
+    cost. features1 and features2 are the features of m1 and m2 if already known,
+    see correspondence for solver and max_dist.
     Returns dictionary of cells in m2 to cells in m1. If a cell is new, the dictionary 
     value is -1.
     """
-    dist, ix1, ix2 = cell_distance(m1, m2)
+    if solver not in SOLVERS:
+        raise ValueError('solver is not valid. should be one of {}.'.format(SOLVERS))
+    
+    dist, ix1, ix2 = cell_distance(m1, m2, features1=features1, features2=features2,
+                                   max_dist=max_dist)
     
     # If dist couldn't be calculated, return dictionary from cells to themselves 
     if dist is None:
         unique_m2 = np.unique(m2)
         return dict(zip(unique_m2, unique_m2))
     
-    solver = Munkres()
-    indexes = solver.compute(make_square(dist))
+    # the pairs out of max_dist get a cost larger than any matching of the 
+    # others, and are not matched if the solver has to choose them
+    gated = ~np.isfinite(dist)
+    if gated.any():
+        dist = np.where(gated, 1 + dist[~gated].sum(), dist)
     
-    # Create dictionary of cell indicies
-    d = dict([(ix2.get(i2, -1), ix1.get(i1, -1)) for i1, i2 in indexes])
-    d.pop(-1, None)  
+    if solver == 'scipy':
+        indexes = zip(*linear_sum_assignment(dist))
+    else:
+        indexes = Munkres().compute(make_square(dist))
+    
+    # Create dictionary of cell indicies, the cells of m2 which are not 
+    # matched are new
+    d = dict.fromkeys(ix2.values(), -1)
+    for i1, i2 in indexes:
+        if i1 in ix1 and i2 in ix2 and not gated[i1, i2]:
+            d[ix2[i2]] = ix1[i1]
     return d
 
 
@@ -130,44 +209,68 @@ def cell_to_features(im, c, nsamples=None, time=None):
             'com_y': com[1]}
     
     
-def cell_distance(m1, m2, weight_com=3):
+def cell_features(m):
+    """
+    Embeds all the cells of mask m into the feature space in one pass over the
+    mask. Returns the array of the cell values and the array of their features
+    (one row per cell): center of mass (com_x, com_y) and area.
+    """
+    m = np.asarray(m)
+    labels = m.ravel().astype(np.intp, copy=False)
+    area = np.bincount(labels)
+    rows = np.broadcast_to(np.arange(m.shape[0], dtype=np.float64)[:, None], m.shape)
+    cols = np.broadcast_to(np.arange(m.shape[1], dtype=np.float64)[None, :], m.shape)
+    sum_x = np.bincount(labels, weights=rows.ravel(), minlength=len(area))
+    sum_y = np.bincount(labels, weights=cols.ravel(), minlength=len(area))
+    
+    cells = np.nonzero(area)[0]
+    cells = cells[cells != 0]
+    area = area[cells]
+    features = np.column_stack((sum_x[cells] / area, sum_y[cells] / area, area))
+    return cells, features
+    
+    
+def cell_distance(m1, m2, weight_com=3, features1=None, features2=None, max_dist=None):
     """
     Gives distance matrix between cells in first and second frame, by embedding
     all cells into the feature space. Currently uses center of mass and area
     as features, with center of mass weighted with factor weight_com (to 
-    make it more important).
+    make it more important). features1 and features2 are the features of m1 
+    and m2 (see cell_features), computed if not given. If max_dist is given, 
+    the distance is only computed for the pairs of cells whose centers of mass
+    are at most max_dist pixels apart (found with a KD-tree), it is inf for 
+    the other pairs.
     """
-    # Modify to compute use more computed features
-    #cols = ['com_x', 'com_y', 'roundness', 'sqrtarea']
-    cols = ['com_x', 'com_y', 'area']
-
-    def get_features(m, t):
-        cells = list(np.unique(m))
-        if 0 in cells:
-            cells.remove(0)
-        features = [cell_to_features(m, c, time=t) for c in cells]
-        return pd.DataFrame(features), dict(enumerate(cells))
-    
-    # Create df, rescale
-    feat1, ix_to_cell1 = get_features(m1, 1)
-    feat2, ix_to_cell2 = get_features(m2, 2)
+    cells1, feat1 = features1 if features1 is not None else cell_features(m1)
+    cells2, feat2 = features2 if features2 is not None else cell_features(m2)
     
     # Check if one of matrices doesn't contain cells
     if len(feat1)==0 or len(feat2)==0:
         return None, None, None
     
-    df = pd.concat((feat1, feat2))
-    df[cols] = scale(df[cols])
+    if max_dist is not None:
+        # candidate pairs, before the features are standardized
+        pairs = cKDTree(feat1[:, :2]).sparse_distance_matrix(
+            cKDTree(feat2[:, :2]), max_dist, output_type='ndarray')
+    
+    # standardize the features of both frames together, like sklearn's scale
+    feat = np.concatenate((feat1, feat2))
+    std = feat.std(axis=0)
+    std[std == 0] = 1
+    feat = (feat - feat.mean(axis=0)) / std
     
     # give more importance to center of mass
-    df[['com_x', 'com_y']] = df[['com_x', 'com_y']] * weight_com
+    feat[:, :2] *= weight_com
 
     # pairwise euclidean dist
-    dist = euclidean_distances(
-        df.loc[df['time']==1][cols],
-        df.loc[df['time']==2][cols]
-    )
-    return dist, ix_to_cell1, ix_to_cell2
+    feat1, feat2 = feat[:len(feat1)], feat[len(feat1):]
+    if max_dist is None:
+        dist = np.sqrt(((feat1[:, None, :] - feat2[None, :, :])**2).sum(axis=-1))
+    else:
+        dist = np.full((len(feat1), len(feat2)), np.inf)
+        i, j = pairs['i'], pairs['j']
+        dist[i, j] = np.sqrt(((feat1[i] - feat2[j])**2).sum(axis=-1))
+    return dist, dict(enumerate(cells1)), dict(enumerate(cells2))
     
     
 def zero_pad(m, shape):
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Relabelling of the masks with the assignments of the trackers (see hungarian
+and gcn). The assignment is turned into a lookup table, which is applied to
+the whole mask in one indexing operation instead of one comparison of the
+mask per cell.
+"""
+
+import numpy as np
+
+
+def resolve_new_cells(assignment, newcell):
+    """
+    Returns the assignment (dict from the cells of the current mask to the
+    cells of the previous one) where the new cells (value -1) are given the
+    identifiers newcell, newcell+1, ... in the order of the dict.
+    """
+    mapping = {}
+    for key, val in assignment.items():
+        # If new cell
+        if val == -1:
+            val = newcell
+            newcell += 1
+        mapping[key] = val
+    return mapping
+
+
+def remap_labels(mask, mapping):
+    """
+    Returns a copy of mask where every label key of mapping is replaced by
+    mapping[key], the other labels are unchanged. The dtype of mask is kept
+    unless the new labels do not fit in it.
+    """
+    mask = np.asarray(mask)
+    labels = mask if np.issubdtype(mask.dtype, np.integer) else mask.astype(np.intp)
+
+    size = int(labels.max(initial=0)) + 1
+    keys = np.array([k for k in mapping if k < size], dtype=np.intp)
+    vals = np.array([mapping[k] for k in keys], dtype=np.int64)
+
+    dtype = mask.dtype
+    if np.issubdtype(dtype, np.integer) and vals.size and vals.max() > np.iinfo(dtype).max:
+        dtype = np.promote_types(dtype, np.min_scalar_type(vals.max()))
+    lut = np.arange(size).astype(dtype)
+    lut[keys] = vals
+    return lut[labels]
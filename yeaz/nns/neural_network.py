@@ -6,6 +6,10 @@ Created on Sat Dec 21 18:54:10 2019
 """
 import os
 import sys
+import threading
+import warnings
+import weakref
+import contextlib
 from .model_pytorch import UNet
 # from model_tensorflow import unet
 import numpy as np
@@ -51,20 +55,12 @@ def report_gpu():
     torch.cuda.empty_cache()
     print('Memory allocated: ', torch.cuda.memory_allocated())
 
-def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', device=None):
+
+def get_weights_path(mic_type, pretrained_weights=None, model_type='pytorch'):
+    """
+    Returns the path to the weights of the network, which is pretrained_weights
+    if given, otherwise the path of the bundled weights for the mic_type.
     """
-    Calculate the prediction of the label corresponding to image im
-    Param:
-        im: a numpy array image (numpy array), with max size 2048x2048
-    Return:
-        res: the predicted distribution of probability of the labels (numpy array)
-    """        
-    # pad with zeros such that is divisible by 16
-    (nrow, ncol) = im.shape
-    row_add = 16-nrow%16
-    col_add = 16-ncol%16
-    padded = np.pad(im, ((0, row_add), (0, col_add)))
-    
     if pretrained_weights is None:
         if mic_type == 'pc':
             pretrained_weights = str(path_weights) + '/' + 'weights_budding_PhC_multilab_0_1'
@@ -74,6 +70,158 @@ def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', devi
             pretrained_weights = str(path_weights) + '/' + 'weights_fission_multilab_0_2'
         if model_type == 'tensorflow':
             pretrained_weights = pretrained_weights + '.hdf5'
+    return pretrained_weights
+
+
+# precisions the network can be run in, the weights are always float32
+PRECISIONS = ['float32', 'bfloat16']
+
+
+def inference_context(device, precision='float32'):
+    """
+    Returns the context manager in which the network is run with the given
+    precision: float32, or bfloat16 where torch autocast considers it safe 
+    (convolutions), which is faster on CPUs with bfloat16 support and halves
+    the memory of the activations.
+    """
+    if precision == 'float32':
+        return contextlib.nullcontext()
+    elif precision == 'bfloat16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError('precision is not valid. should be one of {}.'.format(PRECISIONS))
+
+
+def get_device(device=None):
+    """Returns the torch device to run on, cuda is only used if available"""
+    if torch.cuda.is_available() and device == 'cuda':
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+def get_export_path(pretrained_weights):
+    """Returns the path of the exported TorchScript model of the weights file
+    pretrained_weights, see export_model"""
+    return str(pretrained_weights) + '.torchscript'
+
+
+def export_model(mic_type, pretrained_weights=None, path=None):
+    """
+    Exports the UNet with the weights for mic_type (or pretrained_weights) as
+    a frozen TorchScript model for the CPU, saved to path (by default next 
+    to the weights, see get_export_path). The model is traced, the weights 
+    are folded into the graph as constants and the convolutions are fused 
+    with the following ReLUs, such that it runs without the python overhead 
+    of the modules. Returns the path of the exported model.
+    """
+    pretrained_weights = str(get_weights_path(mic_type, pretrained_weights))
+    if not os.path.exists(pretrained_weights):
+        raise ValueError('Path does not exist')
+    if path is None:
+        path = get_export_path(pretrained_weights)
+    
+    model = UNet()
+    model.load_state_dict(torch.load(pretrained_weights, map_location='cpu'))
+    model.eval()
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter('ignore', FutureWarning)
+        traced = torch.jit.trace(model, torch.zeros(1, 1, 256, 256))
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    frozen.save(path)
+    return path
+
+
+def load_exported_model(pretrained_weights):
+    """Returns the exported model of the weights file pretrained_weights, or 
+    None if it was not exported or the weights were modified since"""
+    path = get_export_path(pretrained_weights)
+    if (not os.path.exists(path) 
+        or os.path.getmtime(path) < os.path.getmtime(pretrained_weights)):
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return torch.jit.load(path, map_location='cpu')
+
+
+# pytorch models which are already loaded, keyed by 
+# (mic_type, weights path, device, exported), see get_model
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(mic_type, pretrained_weights=None, device=None, precision='float32'):
+    """
+    Returns the UNet with the weights for mic_type (or pretrained_weights) 
+    on the given device, in eval mode. The weights are only loaded from the 
+    disk the first time, the model is then reused by all the following 
+    calls until it is removed with evict_models. On the CPU in float32, the
+    exported model (see export_model) is used if there is one.
+    """
+    pretrained_weights = str(get_weights_path(mic_type, pretrained_weights))
+    device = get_device(device)
+    # the exported model is fused for the CPU and cannot be autocast
+    exported = device.type == 'cpu' and precision == 'float32'
+    key = (mic_type, pretrained_weights, device.type, exported)
+    
+    with _models_lock:
+        if key not in _models:
+            if not os.path.exists(pretrained_weights):
+                raise ValueError('Path does not exist')
+            model = load_exported_model(pretrained_weights) if exported else None
+            if model is None:
+                model = UNet()
+                model.load_state_dict(torch.load(pretrained_weights, map_location='cpu'))
+                model = model.to(device)
+                model.eval()
+            _models[key] = model
+        return _models[key]
+
+
+def evict_models(mic_type=None, pretrained_weights=None, device=None):
+    """
+    Removes the loaded models from the cache to free memory. Only the models
+    matching the given mic_type, weights path and device are removed, all
+    models are removed if no argument is given. The reusable input tensors
+    (see input_tensor_for) of all the threads on the device are freed too.
+    """
+    if pretrained_weights is not None:
+        pretrained_weights = str(pretrained_weights)
+    with _models_lock:
+        for key in list(_models):
+            if ((mic_type is None or key[0] == mic_type)
+                and (pretrained_weights is None or key[1] == pretrained_weights)
+                and (device is None or key[2] == device)):
+                del _models[key]
+    with _input_tensors_lock:
+        for tensors in list(_input_tensors_all):
+            for key in list(tensors):
+                if device is None or key[1] == device:
+                    del tensors[key]
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', device=None,
+               tile_size=None, overlap=128, precision='float32'):
+    """
+    Calculate the prediction of the label corresponding to image im
+    Param:
+        im: a numpy array image (numpy array), with max size 2048x2048 unless
+            tile_size is given
+        tile_size: if not None, images larger than tile_size are predicted 
+            tile by tile, see predict_tiled
+        precision: precision of the network, see inference_context
+    Return:
+        res: the predicted distribution of probability of the labels (numpy array)
+    """        
+    if (tile_size is not None and model_type == 'pytorch' 
+        and (im.shape[0] > tile_size or im.shape[1] > tile_size)):
+        return predict_tiled(im, mic_type, pretrained_weights, device=device,
+                             tile_size=tile_size, overlap=overlap, precision=precision)
+    
+    (nrow, ncol) = im.shape
+    
+    pretrained_weights = get_weights_path(mic_type, pretrained_weights, model_type)
     
     if not os.path.exists(pretrained_weights):
         raise ValueError('Path does not exist')
@@ -81,6 +229,8 @@ def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', devi
     # WHOLE CELL PREDICTION
 
     if model_type == 'tensorflow':
+        # pad with zeros such that is divisible by 16
+        padded = np.pad(im, ((0, padding_size(nrow)), (0, padding_size(ncol))))
         tf_model = unet(pretrained_weights = pretrained_weights,
                     input_size = (None,None,1))
         input = padded[np.newaxis,:,:,np.newaxis]
@@ -90,31 +240,20 @@ def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', devi
         return tf_res
 
     elif model_type == 'pytorch':
-        # Load saved weights in pytorch model and run the pytorch model
-        model = UNet()
-        model.load_state_dict(torch.load(pretrained_weights))
-        
-        if torch.cuda.is_available() and device == 'cuda':
-            device = torch.device('cuda')
-            model = model.to(device)
-            padded = torch.from_numpy(padded).to(device)
-            # print('device: ', device)
-        else:
-            device = torch.device('cpu')
-            padded = torch.from_numpy(padded)
-            # print('device: ', device)
-        model.eval()
-        with torch.no_grad():
-            # Convert input tensor to PyTorch tensor
-            input_tensor = padded.unsqueeze(0).unsqueeze(0).float()
+        # Get the pytorch model with the saved weights, loaded only once
+        model = get_model(mic_type, pretrained_weights, device, precision)
+        device = get_device(device)
+        with torch.no_grad(), inference_context(device, precision):
+            # Copy the image to the zero-padded input tensor
+            input_tensor = input_tensor_for(im[np.newaxis], device)
             # Pass input through the model
             output_tensor = model.forward(input_tensor)
             # Convert output tensor to NumPy array
-            output_array = output_tensor.cpu().detach().numpy()
+            output_array = output_tensor.float().cpu().detach().numpy()
         pt_res = output_array[0, 0, :, :]
         
         # empty cache
-        if (device == 'cuda') and (torch.cuda.is_available()):
+        if device.type == 'cuda':
             report_gpu()
         
         return pt_res[:nrow, :ncol]
@@ -122,3 +261,168 @@ def prediction(im, mic_type, pretrained_weights=None, model_type='pytorch', devi
     
     else:
         raise ValueError('model_type is not valid. should be either "pytorch" or "tensorflow".')
+
+
+def padding_size(n, multiple=16):
+    """Returns the smallest number of pixels to add to a size n such that it 
+    is divisible by multiple, as required by the 4 pooling layers of the UNet"""
+    return (-n) % multiple
+
+
+class _InputTensors(dict):
+    # dict which can be kept in the WeakSet _input_tensors_all, compared by
+    # identity such that the dicts of two threads are never merged
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+
+
+# zero-padded input tensors of the network, reused for the following batches
+# of the same padded shape, keyed by (shape, device) in each thread. The 
+# tensors of all the threads are also kept in _input_tensors_all, such that
+# evict_models can free them
+_input_tensors = threading.local()
+_input_tensors_all = weakref.WeakSet()
+_input_tensors_lock = threading.Lock()
+_MAX_INPUT_TENSORS = 4
+
+
+def input_tensor_for(images, device):
+    """
+    Returns the float32 tensor of shape (nimages, 1, nrow, ncol) passed to the
+    network for the stack of images, padded with zeros at the bottom and 
+    right to the next multiple of 16. Images whose sizes round up to the same
+    multiples of 16 share one tensor, which is only allocated once and is 
+    overwritten by the next call.
+    """
+    (nimages, nrow, ncol) = images.shape
+    shape = (nimages, 1, nrow + padding_size(nrow), ncol + padding_size(ncol))
+    key = (shape, device.type)
+    
+    tensors = getattr(_input_tensors, 'tensors', None)
+    if tensors is None:
+        tensors = _input_tensors.tensors = _InputTensors()
+        with _input_tensors_lock:
+            _input_tensors_all.add(tensors)
+    
+    with _input_tensors_lock:
+        if key not in tensors:
+            if len(tensors) >= _MAX_INPUT_TENSORS:
+                # e.g. the last smaller batch of each field of view
+                del tensors[next(iter(tensors))]
+            tensors[key] = [torch.zeros(shape, dtype=torch.float32, device=device), (nrow, ncol)]
+        entry = tensors[key]
+    tensor, written = entry
+    if written != (nrow, ncol):
+        # the padding has to be zero again after a larger image
+        tensor.zero_()
+        entry[1] = (nrow, ncol)
+    tensor[:, 0, :nrow, :ncol].copy_(torch.from_numpy(np.asarray(images, dtype=np.float32)))
+    return tensor
+
+
+def predict_batch(images, mic_type, pretrained_weights=None, device=None, batch_size=4,
+                  tile_size=None, overlap=128, precision='float32'):
+    """
+    Calculate the predictions for a stack of images of the same size, by 
+    passing them through the network in mini-batches of batch_size images.
+    Param:
+        images: a stack of images, numpy array of shape (nimages, nrow, ncol)
+        tile_size: if not None, images larger than tile_size are predicted 
+            tile by tile, see predict_tiled
+        precision: precision of the network, see inference_context
+    Return:
+        res: the predicted distributions of probability of the labels, 
+             numpy array of shape (nimages, nrow, ncol)
+    """
+    images = np.asarray(images)
+    (nimages, nrow, ncol) = images.shape
+    
+    if tile_size is not None and (nrow > tile_size or ncol > tile_size):
+        return np.array([predict_tiled(im, mic_type, pretrained_weights, device=device,
+                                       tile_size=tile_size, overlap=overlap, 
+                                       batch_size=batch_size, precision=precision)
+                         for im in images])
+    
+    model = get_model(mic_type, pretrained_weights, device, precision)
+    device = get_device(device)
+    
+    res = np.zeros((nimages, nrow, ncol), dtype=np.float32)
+    with torch.no_grad(), inference_context(device, precision):
+        for start in range(0, nimages, batch_size):
+            input_tensor = input_tensor_for(images[start:start+batch_size], device)
+            output_tensor = model.forward(input_tensor)
+            res[start:start+batch_size] = output_tensor[:, 0, :nrow, :ncol].float().cpu().numpy()
+    
+    # empty cache
+    if device.type == 'cuda':
+        report_gpu()
+    
+    return res
+
+
+def _tile_starts(n, tile_size, overlap):
+    """Start coordinates of tiles of size tile_size covering the range n, 
+    with at least overlap pixels of overlap between neighbouring tiles."""
+    if n <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    starts = list(range(0, n - tile_size, step))
+    starts.append(n - tile_size)
+    return starts
+
+
+def _blend_ramp(size, overlap, start_edge, end_edge):
+    """1D blending weights of a tile, which increase linearly over the 
+    overlap at the tile borders which are not at the image border."""
+    w = np.ones(size, dtype=np.float32)
+    ramp = np.arange(1, overlap+1, dtype=np.float32) / (overlap+1)
+    n = min(overlap, size)
+    if not start_edge:
+        w[:n] = ramp[:n]
+    if not end_edge:
+        w[size-n:] = np.minimum(w[size-n:], ramp[:n][::-1])
+    return w
+
+
+def predict_tiled(im, mic_type, pretrained_weights=None, device=None, 
+                  tile_size=1024, overlap=128, batch_size=1, precision='float32'):
+    """
+    Calculate the prediction of a large image tile by tile, such that the 
+    memory used by the network only depends on tile_size and not on the size
+    of the image. Neighbouring tiles overlap by at least overlap pixels, the
+    predictions are blended with linear weights over the overlaps to avoid
+    seams.
+    Param:
+        im: a numpy array image (numpy array), of any size
+        tile_size: size of the square tiles passed through the network, 
+            rounded up to a multiple of 16
+        overlap: minimal overlap between neighbouring tiles, in pixels
+        batch_size: number of tiles passed through the network at once
+        precision: precision of the network, see inference_context
+    Return:
+        res: the predicted distribution of probability of the labels (numpy array)
+    """
+    tile_size = int(np.ceil(tile_size / 16) * 16)
+    if overlap >= tile_size:
+        raise ValueError('overlap must be smaller than tile_size')
+    
+    (nrow, ncol) = im.shape
+    tile_rows = min(tile_size, nrow)
+    tile_cols = min(tile_size, ncol)
+    starts = [(r, c) for r in _tile_starts(nrow, tile_size, overlap)
+                     for c in _tile_starts(ncol, tile_size, overlap)]
+    
+    res = np.zeros((nrow, ncol), dtype=np.float32)
+    weights = np.zeros((nrow, ncol), dtype=np.float32)
+    for i in range(0, len(starts), batch_size):
+        batch = starts[i:i+batch_size]
+        tiles = np.array([im[r:r+tile_rows, c:c+tile_cols] for r, c in batch])
+        preds = predict_batch(tiles, mic_type, pretrained_weights, device=device, 
+                              batch_size=batch_size, precision=precision)
+        for (r, c), pred in zip(batch, preds):
+            w = np.outer(_blend_ramp(tile_rows, overlap, r == 0, r + tile_rows == nrow),
+                         _blend_ramp(tile_cols, overlap, c == 0, c + tile_cols == ncol))
+            res[r:r+tile_rows, c:c+tile_cols] += w * pred
+            weights[r:r+tile_rows, c:c+tile_cols] += w
+    
+    return res / weights
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipelined segmentation of the frames of one field of view.
+
+The frames go through four stages which run at the same time and are
+connected by bounded queues:
+    - reader threads load the images in chunks with reader.LoadFrames (one
+      pass over the file per chunk) and preprocess them,
+    - the inference stage passes batches of images through the network,
+    - the post-processing stage (threshold and watershed) runs in a pool of
+      worker processes, see segment.SegmentationPool,
+    - the writer thread saves the masks to the hdf file.
+The bounded queues keep the memory used constant, the throughput is limited
+by the slowest stage. Frames with a stored prediction skip the inference 
+stage. A fingerprint (e.g. a hash) of every loaded image can be computed in
+the reader threads, without loading the images a second time.
+"""
+
+import queue
+import threading
+
+import tqdm
+
+
+# marks the end of the stream of frames in the queues
+_DONE = object()
+
+
+def run_pipeline(reader, fov_ind, frames, preprocess, predict, postprocess,
+                 submit=None, cached=None, store=None, fingerprint=None, n_readers=1, 
+                 batch_size=4, queue_size=8):
+    """
+    Segments the frames of the field of view fov_ind and saves the masks
+    with reader.SaveMask.
+    Param:
+        frames: the time indices to segment
+        preprocess: function applied to each image, run in the reader threads
+        predict: function which returns the stack of predictions for a list
+            of preprocessed images
+        postprocess: function which returns the mask for a prediction, run
+            in the writer thread if submit is None
+        submit: function which starts the post-processing of a prediction 
+            and returns a Future of the mask, e.g. SegmentationPool.submit
+        cached: function which returns the stored prediction of a time index
+            and the fingerprint of its image, or None if the frame has to go 
+            through predict
+        store: function called with each time index, the fingerprint of its
+            image and its new prediction, which returns the prediction to 
+            post-process
+        fingerprint: function applied to each loaded image in the reader 
+            threads, e.g. image_hash, the fingerprint is None if not given
+        n_readers: number of threads loading and preprocessing images
+        batch_size: number of images passed at once to predict, and number
+            of images loaded at once by a reader thread
+        queue_size: maximal number of frames waiting between two stages
+    Return:
+        dict of the fingerprints of the images of the frames
+    """
+    frames = list(frames)
+    n_readers = max(1, n_readers)
+
+    todo = queue.Queue()
+    for i in range(0, len(frames), max(1, batch_size)):
+        todo.put(frames[i:i+batch_size])
+    preprocessed = queue.Queue(maxsize=queue_size)
+    predicted = queue.Queue(maxsize=queue_size)
+
+    errors = []
+    stop = threading.Event()
+    fingerprints = {}
+
+    def put(q, item):
+        # put which gives up when the pipeline is stopped by an error
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            while not stop.is_set():
+                try:
+                    chunk = todo.get_nowait()
+                except queue.Empty:
+                    break
+                for t, im in zip(chunk, reader.LoadFrames(fov_ind, chunk)):
+                    if stop.is_set():
+                        return
+                    fingerprints[t] = fingerprint(im) if fingerprint is not None else None
+                    pred = cached(t, fingerprints[t]) if cached is not None else None
+                    if pred is not None:
+                        # the frame goes straight to post-processing
+                        if submit is not None:
+                            pred = submit(pred)
+                        if not put(predicted, (t, pred)):
+                            return
+                        continue
+                    im = preprocess(im)
+                    if not put(preprocessed, (t, im)):
+                        return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(preprocessed, _DONE)
+
+    def write():
+        try:
+            with tqdm.tqdm(total=len(frames), desc='Segmenting frames', leave=True) as pbar:
+                while True:
+                    item = predicted.get()
+                    if item is _DONE:
+                        break
+                    t, pred = item
+                    if submit is not None:
+                        mask = pred.result()
+                    else:
+                        mask = postprocess(pred)
+                    reader.SaveMask(t, fov_ind, mask)
+                    pbar.update(1)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            # keep consuming such that the inference stage is not blocked
+            while predicted.get() is not _DONE:
+                pass
+
+    readers = [threading.Thread(target=read, daemon=True) for _ in range(n_readers)]
+    writer = threading.Thread(target=write, daemon=True)
+    for thread in readers:
+        thread.start()
+    writer.start()
+
+    # inference stage, in the calling thread
+    try:
+        finished = 0
+        batch = []
+        while finished < n_readers and not stop.is_set():
+            try:
+                item = preprocessed.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                finished += 1
+            else:
+                batch.append(item)
+            if batch and (len(batch) == batch_size or finished == n_readers):
+                ts, ims = zip(*batch)
+                batch = []
+                preds = predict(list(ims))
+                for t, pred in zip(ts, preds):
+                    if store is not None:
+                        pred = store(t, fingerprints[t], pred)
+                    if submit is not None:
+                        pred = submit(pred)
+                    if not put(predicted, (t, pred)):
+                        break
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        predicted.put(_DONE)
+        writer.join()
+        for thread in readers:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return fingerprints
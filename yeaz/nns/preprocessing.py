@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preprocessing of the images before they are passed through the neural network.
+
+The images are equalized with CLAHE (contrast limited adaptive histogram
+equalization). This is the algorithm of skimage.exposure.equalize_adapthist
+for 2D images, adapted from "Contrast Limited Adaptive Histogram Equalization"
+by Karel Zuiderveld, Graphics Gems IV, Academic Press, 1994, with the same
+output converted to float32. Instead of full-size float64 temporaries, the
+gray levels are mapped with lookup tables, the interpolation is done one row
+of contextual regions at a time and the full-size buffers are allocated once
+per image shape and reused for the following frames.
+"""
+
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage.exposure import rescale_intensity
+from skimage.util import img_as_uint
+
+
+# name of the preprocessing, part of the key of the stored predictions
+PREPROCESSING = 'equalize_adapthist'
+
+NR_OF_GRAY = 2**14  # number of grayscale levels to use in CLAHE algorithm
+
+
+class CLAHE:
+
+
+    def __init__(self, shape, kernel_size=None, clip_limit=0.01, nbins=256):
+        """
+        Equalizes 2D images of the given shape, see equalize_adapthist for
+        the parameters.
+        """
+        self.shape = tuple(shape)
+        self.nbins = nbins
+
+        if kernel_size is None:
+            kernel_size = tuple([max(s // 8, 1) for s in self.shape])
+        elif np.isscalar(kernel_size):
+            kernel_size = (kernel_size,) * 2
+        elif len(kernel_size) != 2:
+            raise ValueError(f'Incorrect value of `kernel_size`: {kernel_size}')
+        self.kernel_size = [int(k) for k in kernel_size]
+
+        # the image is padded such that the shape in each dimension is a
+        # multiple of the kernel_size and is preceded by half a kernel size
+        self.pad_start = [k // 2 for k in self.kernel_size]
+        self.pad_end = [(k - s % k) % k + int(np.ceil(k / 2.0))
+                        for k, s in zip(self.kernel_size, self.shape)]
+        padded_shape = [s + p_i + p_f for s, p_i, p_f
+                        in zip(self.shape, self.pad_start, self.pad_end)]
+        self.ns_hist = [int(s / k) - 1 for s, k in zip(padded_shape, self.kernel_size)]
+
+        kernel_elements = math.prod(self.kernel_size)
+        self.kernel_elements = kernel_elements
+        if clip_limit > 0.0:
+            self.clim = int(np.clip(clip_limit * kernel_elements, 1, None))
+        else:
+            # largest possible value, i.e., do not clip (AHE)
+            self.clim = kernel_elements
+
+        # lookup table of the gray level bins
+        bin_size = 1 + NR_OF_GRAY // nbins
+        self.bin_lut = np.arange(NR_OF_GRAY, dtype=np.min_scalar_type(NR_OF_GRAY)) // bin_size
+
+        # buffers reused for all the images
+        self.bins = np.zeros(padded_shape, dtype=np.min_scalar_type(nbins - 1))
+        self.levels = np.zeros(self.shape, dtype=np.uint16)
+
+        # block and interpolation coefficients of the rows and columns of
+        # the image, in the coordinates of the padded image
+        self.blocks, self.coeffs, self.inv_coeffs = [], [], []
+        for p, s, k in zip(self.pad_start, self.shape, self.kernel_size):
+            pos = np.arange(p, p + s)
+            c = (np.arange(k) / k)[pos % k]
+            self.blocks.append(pos // k)
+            self.coeffs.append(c)
+            self.inv_coeffs.append(1 - c)
+
+
+    def __call__(self, image, out=None):
+        """Returns the equalized image as float32, in out if given"""
+        image = np.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError('Image of shape {} instead of {}'.format(image.shape, self.shape))
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+
+        self._bin_image(image)
+        map_array = self._map_array()
+        self._interpolate(map_array)
+
+        # rescale the result to [0, 1], the same values as skimage in float64
+        # rounded to float32
+        lmin, lmax = int(self.levels.min()), int(self.levels.max())
+        lut = np.zeros(lmax + 1, dtype=np.float32)
+        lut[lmin:] = rescale_intensity(np.arange(lmin, lmax + 1, dtype=np.float64))
+        np.take(lut, self.levels, out=out)
+        return out
+
+
+    def _bin_image(self, image):
+        """Scales the image to NR_OF_GRAY levels and writes the gray level
+        bins to the padded buffer, with reflected borders"""
+        if image.dtype != np.uint16:
+            image = img_as_uint(image)
+
+        # lookup table from the values of the image to the bins, the levels
+        # are computed by skimage on the range of values only
+        imin, imax = int(image.min()), int(image.max())
+        values = np.arange(imin, imax + 1, dtype=np.uint16)
+        levels = np.round(rescale_intensity(values, in_range=(float(imin), float(imax)),
+                                            out_range=(0, NR_OF_GRAY - 1)))
+        lut = np.zeros(imax + 1, dtype=self.bins.dtype)
+        lut[imin:] = self.bin_lut[levels.astype(np.min_scalar_type(NR_OF_GRAY))]
+
+        (py, px), (ey, ex) = self.pad_start, self.pad_end
+        (h, w) = self.shape
+        self.bins[py:py+h, px:px+w] = lut[image]
+
+        if py >= h or ey >= h or px >= w or ex >= w:
+            # reflections of reflections, only for tiny images
+            self.bins[...] = np.pad(self.bins[py:py+h, px:px+w],
+                                    [[py, ey], [px, ex]], mode='reflect')
+            return
+
+        b = self.bins
+        b[:py, px:px+w] = b[2*py:py:-1, px:px+w]
+        b[py+h:, px:px+w] = b[py+h-1-ey:py+h-1, px:px+w][::-1]
+        b[:, :px] = b[:, 2*px:px:-1]
+        b[:, px+w:] = b[:, px+w-1-ex:px+w-1][:, ::-1]
+
+
+    def _map_array(self):
+        """Returns the gray level mappings of the contextual regions, with
+        the leading mappings duplicated in each dimension"""
+        (ky, kx), (ny, nx) = self.kernel_size, self.ns_hist
+        nbins = self.nbins
+
+        # histograms of the contextual regions, one row of regions at a time
+        col_offsets = (np.arange(nx * kx) // kx) * nbins
+        hist = np.empty((ny, nx, nbins), dtype=np.int64)
+        for r in range(ny):
+            rows = self.bins[ky//2 + r*ky:ky//2 + (r+1)*ky, kx//2:kx//2 + nx*kx]
+            idx = rows + col_offsets
+            hist[r] = np.bincount(idx.ravel(), minlength=nx*nbins).reshape(nx, nbins)
+
+        hist = clip_histograms(hist.reshape(ny*nx, nbins), self.clim)
+        hist = map_histogram(hist, 0, NR_OF_GRAY - 1, self.kernel_elements)
+        hist = hist.reshape(ny, nx, nbins)
+
+        # duplicate leading mappings in each dim
+        return np.pad(hist, [[1, 1], [1, 1], [0, 0]], mode='edge')
+
+
+    def _interpolate(self, map_array):
+        """Writes to self.levels the gray levels of the image, interpolated
+        between the mappings of the neighbouring contextual regions. The sum
+        of the contributions is computed like in skimage (each in float64,
+        rounded to float32 and summed in float32), one row of regions at a
+        time."""
+        (py, px), (h, w) = self.pad_start, self.shape
+        (ky, kx) = self.kernel_size
+        nbins = self.nbins
+        ncols = map_array.shape[1]
+        flat_maps = map_array.ravel()
+
+        rblocks, cblocks = self.blocks
+        yc, xc = self.coeffs
+        inv_yc, inv_xc = self.inv_coeffs
+
+        for r in np.unique(rblocks):
+            rows = np.nonzero(rblocks == r)[0]
+            y0, y1 = rows[0], rows[-1] + 1
+            bins = self.bins[py+y0:py+y1, px:px+w]
+            result = np.zeros((y1 - y0, w), dtype=np.float32)
+            for ey, ex in np.ndindex(2, 2):
+                idx = bins + (((r + ey) * ncols + cblocks + ex) * nbins)
+                edge_mapped = flat_maps[idx]
+                edge_coeffs = np.multiply.outer([inv_yc, yc][ey][y0:y1], [inv_xc, xc][ex])
+                result += (edge_mapped * edge_coeffs).astype(np.float32)
+            self.levels[y0:y1] = result.astype(np.uint16)
+
+
+def clip_histograms(hist, clip_limit):
+    """
+    Performs clipping of the histograms (rows of hist) and redistribution of
+    the bins, same as skimage.exposure._adapthist.clip_histogram for each of
+    the rows.
+    """
+    hist = np.array(hist)
+    nbins = hist.shape[-1]
+
+    # calculate total number of excess pixels
+    n_excess = np.maximum(hist - clip_limit, 0).sum(-1)
+    np.minimum(hist, clip_limit, out=hist)
+
+    # Second part: clip histogram and redistribute excess pixels in each bin
+    bin_incr = (n_excess // nbins)[:, None]  # average binincrement
+    upper = clip_limit - bin_incr  # Bins larger than upper set to cliplimit
+
+    low_mask = hist < upper
+    n_excess -= (low_mask * bin_incr).sum(-1)
+    hist += low_mask * bin_incr
+
+    mid_mask = (hist >= upper) & (hist < clip_limit)
+    n_excess += ((hist - clip_limit) * mid_mask).sum(-1)
+    hist[mid_mask] = clip_limit
+
+    # Redistribute remaining excess, in the rows where there is some
+    for row in np.nonzero(n_excess > 0)[0]:
+        h = hist[row]
+        n = n_excess[row]
+        while n > 0:
+            prev_n = n
+            for index in range(nbins):
+                under_mask = h < clip_limit
+                step_size = max(1, np.count_nonzero(under_mask) // n)
+                under_mask = under_mask[index::step_size]
+                h[index::step_size][under_mask] += 1
+                n -= np.count_nonzero(under_mask)
+                if n <= 0:
+                    break
+            if prev_n == n:
+                break
+
+    return hist
+
+
+def map_histogram(hist, min_val, max_val, n_pixels):
+    """Calculate the equalized lookup tables (mappings) by cumulating the
+    histograms, along the last dimension of hist."""
+    out = np.cumsum(hist, axis=-1).astype(float)
+    out *= (max_val - min_val) / n_pixels
+    out += min_val
+    np.clip(out, a_min=None, a_max=max_val, out=out)
+    return out.astype(int)
+
+
+# CLAHE instances of every thread, reused for the frames of the same shape
+_local = threading.local()
+
+
+def _get_clahe(shape, kernel_size, clip_limit, nbins):
+    """Returns the CLAHE of the calling thread for the shape and parameters"""
+    key = (tuple(shape), kernel_size if np.isscalar(kernel_size) or kernel_size is None
+           else tuple(kernel_size), clip_limit, nbins)
+    if getattr(_local, 'key', None) != key:
+        _local.clahe = CLAHE(shape, kernel_size, clip_limit, nbins)
+        _local.key = key
+    return _local.clahe
+
+
+def equalize_adapthist(image, kernel_size=None, clip_limit=0.01, nbins=256, out=None):
+    """
+    Contrast limited adaptive histogram equalization of the 2D image, gives
+    the output of skimage.exposure.equalize_adapthist as float32.
+    Param:
+        kernel_size: shape of the contextual regions, by default 1/8 of the
+            height by 1/8 of the width of the image
+        clip_limit: clipping limit, normalized between 0 and 1
+        nbins: number of gray bins for the histograms
+        out: float32 array in which the result is written
+    """
+    image = np.asarray(image)
+    return _get_clahe(image.shape, kernel_size, clip_limit, nbins)(image, out=out)
+
+
+def equalize_adapthist_batch(images, n_workers=None, **kwargs):
+    """
+    Equalizes the images (see equalize_adapthist) in n_workers threads and
+    returns them as a float32 stack if they all have the same shape,
+    otherwise as a list.
+    """
+    images = list(images)
+    if not images:
+        return np.empty((0,), dtype=np.float32)
+    same_shape = len(set(np.shape(im) for im in images)) == 1
+    out = np.empty((len(images),) + np.shape(images[0]), dtype=np.float32) if same_shape else None
+
+    def run(i):
+        res = equalize_adapthist(images[i], out=out[i] if same_shape else None, **kwargs)
+        return res
+
+    if n_workers == 1 or len(images) == 1:
+        results = [run(i) for i in range(len(images))]
+    else:
+        with ThreadPoolExecutor(n_workers) as executor:
+            results = list(executor.map(run, range(len(images))))
+    return out if same_shape else results
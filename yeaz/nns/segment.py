@@ -2,10 +2,15 @@ from scipy import ndimage as ndi
 from skimage.feature import peak_local_max
 from skimage.morphology import dilation
 from skimage.segmentation import watershed
-from skimage.filters import gaussian
+from skimage.filters import gaussian, threshold_isodata
 from skimage.measure import label
 
 import numpy as np
+import heapq
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ProcessPoolExecutor
 
 
 def segment(th, pred, min_distance=10, topology=None): 
@@ -40,129 +45,359 @@ def segment(th, pred, min_distance=10, topology=None):
     return correct_artefacts(merged)
     
     
+def segment_prediction(pred, thr_val=None, min_distance=10):
+    """
+    Thresholds the prediction of the neural network with thr_val (or with 
+    the isodata threshold if thr_val is None) and segments it, see segment.
+    Only depends on numpy/scipy/skimage, such that it can be run in 
+    worker processes.
+    """
+    if thr_val is None:
+        thr_val = threshold_isodata(pred)
+    th = pred > thr_val
+    return segment(th, pred, min_distance)
+    
+    
+def segment_many(preds, thr_val=None, min_distance=10, n_workers=None, pool=None):
+    """
+    Segments the predictions preds (see segment_prediction) in parallel, in
+    the worker processes of pool, or of a new SegmentationPool with n_workers
+    processes if pool is None. Returns the list of the masks.
+    """
+    if pool is not None:
+        return pool.segment_many(preds, thr_val, min_distance)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, len(preds))
+    if n_workers <= 1:
+        return [segment_prediction(pred, thr_val, min_distance) for pred in preds]
+    with SegmentationPool(n_workers) as pool:
+        return pool.segment_many(preds, thr_val, min_distance)
+
+
+class SegmentationPool:
+    """
+    Pool of worker processes running segment_prediction. The predictions 
+    and the masks are exchanged through shared memory, only the names of the 
+    shared memory blocks are sent to the workers. The processes are spawned 
+    once and reused for all the frames until shutdown is called.
+    """
+    
+    
+    def __init__(self, n_workers=None):
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        # the workers are spawned and not forked, as forking a process with 
+        # running threads can deadlock
+        self.executor = ProcessPoolExecutor(
+            n_workers, mp_context=multiprocessing.get_context('spawn'))
+        
+        
+    def submit(self, pred, thr_val=None, min_distance=10):
+        """Starts the segmentation of pred and returns a Future of the mask"""
+        pred = np.asarray(pred)
+        shm_in = shared_memory.SharedMemory(create=True, size=max(pred.nbytes, 1))
+        shm_out = shared_memory.SharedMemory(create=True, size=max(pred.size*4, 1))
+        np.ndarray(pred.shape, pred.dtype, buffer=shm_in.buf)[...] = pred
+        
+        result = Future()
+        
+        def done(future):
+            try:
+                dtype = future.result()
+                mask = np.ndarray(pred.shape, np.uint32, buffer=shm_out.buf).astype(dtype)
+                result.set_result(mask)
+            except BaseException as e:
+                result.set_exception(e)
+            finally:
+                for shm in (shm_in, shm_out):
+                    shm.close()
+                    shm.unlink()
+        
+        try:
+            future = self.executor.submit(_segment_shared, shm_in.name, shm_out.name, 
+                                          pred.shape, pred.dtype.str, thr_val, min_distance)
+        except BaseException:
+            for shm in (shm_in, shm_out):
+                shm.close()
+                shm.unlink()
+            raise
+        future.add_done_callback(done)
+        return result
+    
+    
+    def segment_many(self, preds, thr_val=None, min_distance=10):
+        """Segments the predictions preds and returns the list of the masks"""
+        futures = [self.submit(pred, thr_val, min_distance) for pred in preds]
+        return [future.result() for future in futures]
+    
+    
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+        
+        
+    def __enter__(self):
+        return self
+    
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        
+        
+def _segment_shared(in_name, out_name, shape, dtype, thr_val, min_distance):
+    """Runs segment_prediction in a worker process, on the prediction in the
+    shared memory block in_name. The mask is written as uint32 to the block
+    out_name and its dtype is returned."""
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        pred = np.ndarray(shape, np.dtype(dtype), buffer=shm_in.buf)
+        out = np.ndarray(shape, np.uint32, buffer=shm_out.buf)
+        mask = segment_prediction(pred, thr_val, min_distance)
+        out[...] = mask
+        del pred, out
+        return mask.dtype.str
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
 def correct_artefacts(wsh):
     """
     Sometimes artefacts arise with 3 or less pixels which are surrounded entirely
     by another cell. Those are removed here.
+    
+    Every fragment gets the label found most often on its contour (the 
+    pixels around it, in 4-connectivity), the smallest one on ties, unless 
+    it is the background. The contours of all the fragments are counted in 
+    one pass. Fragments touching other fragments are then processed in the 
+    order of their labels, as the relabeling of one changes the contour of 
+    the other.
     """
     unique, count = np.unique(wsh, return_counts=True)
-    to_remove = unique[count<=3]
-    for rem in to_remove:
-        rem_im = wsh==rem
-        rem_cont = dilation(rem_im) & ~rem_im
-        vals, val_counts = np.unique(wsh[rem_cont], return_counts=True)
+    to_remove = unique[count<=3].astype(np.int64)
+    if len(to_remove) == 0:
+        return wsh
+    
+    labels = wsh.astype(np.int64)
+    is_small = np.zeros(labels.max()+1, dtype=bool)
+    is_small[to_remove] = True
+    
+    # label of every contour pixel of every fragment, each contour pixel 
+    # counted once per fragment
+    rows, cols = np.nonzero(is_small[labels])
+    frag, nbr = contour_pixels(labels, rows, cols)
+    nbr_labels = labels.flat[nbr]
+    
+    # fragments touching another fragment
+    linked = np.unique(frag[is_small[nbr_labels]])
+    
+    # majority label on the contour of the other fragments
+    pairs, pair_counts = np.unique(np.stack([frag, nbr_labels]), axis=1, return_counts=True)
+    order = np.lexsort((pairs[1], -pair_counts, pairs[0]))
+    pairs = pairs[:, order]
+    first = np.r_[True, pairs[0,1:] != pairs[0,:-1]]
+    majority = np.arange(len(is_small))
+    majority[pairs[0,first]] = pairs[1,first]
+    majority[linked] = linked
+    
+    lab = labels[rows, cols]
+    replace = (majority[lab] != lab) & (majority[lab] != 0)
+    wsh[rows[replace], cols[replace]] = majority[lab[replace]]
+    
+    # fragments touching other fragments, in order
+    for rem in linked:
+        in_rem = labels[rows, cols] == rem
+        rem_rows, rem_cols = rows[in_rem], cols[in_rem]
+        _, nbr = contour_pixels(labels, rem_rows, rem_cols)
+        if len(nbr) == 0:
+            continue
+        vals, val_counts = np.unique(labels.flat[nbr], return_counts=True)
         replace_val = vals[np.argmax(val_counts)]
         if replace_val != 0:
-            wsh[rem_im] = int(replace_val)
+            wsh[rem_rows, rem_cols] = int(replace_val)
+            labels[rem_rows, rem_cols] = replace_val
     return wsh
 
 
+def contour_pixels(labels, rows, cols):
+    """
+    Returns the unique pairs (label of pixel, flat index of neighbour) of the
+    4-neighbours of the given pixels which have another label.
+    """
+    h, w = labels.shape
+    lab = labels[rows, cols]
+    frag, nbr = [], []
+    for dy, dx in [(-1,0), (1,0), (0,-1), (0,1)]:
+        nrows, ncols = rows + dy, cols + dx
+        valid = (nrows >= 0) & (nrows < h) & (ncols >= 0) & (ncols < w)
+        valid[valid] = labels[nrows[valid], ncols[valid]] != lab[valid]
+        frag.append(lab[valid])
+        nbr.append(nrows[valid]*w + ncols[valid])
+    pairs = np.unique(np.stack([np.concatenate(frag), np.concatenate(nbr)]), axis=1)
+    return pairs[0], pairs[1]
+
+
 def cell_merge(wsh, pred):
     """
     Procedure that merges cells if the border between them is predicted to be
     cell pixels.
-    """
-    wshshape=wsh.shape
     
-    # masks for the original cells
-    objs = np.zeros((wsh.max()+1,wshshape[0],wshshape[1]), dtype=bool)	
-    
-    # masks for dilated cells
-    dil_objs = np.zeros((wsh.max()+1,wshshape[0],wshshape[1]), dtype=bool)
-    
-    # bounding box coordinates	
-    obj_coords = np.zeros((wsh.max()+1,4))
+    The cells are visited in the order of their labels, and every cell is 
+    compared to the following cells it touches, such that a group of merged 
+    cells is compared to the cells touching any of its members. The borders
+    are evaluated on crops around the cells, only the labels and the 
+    adjacency graph of the cells are kept for the whole image.
+    """
+    nobjs = int(wsh.max())
     
-    # cleaned watershed, output of function	
-    wshclean = np.zeros((wshshape[0],wshshape[1]))
+    if nobjs == 0:
+        return np.zeros(wsh.shape, dtype=np.uint16)
     
-    # kernel to dilate objects
-    kernel = np.ones((3,3), dtype=bool)	
+    # slot obj of the cell with label obj+1, a group of merged cells is 
+    # stored in the slot of its last cell. owner is the slot of every label, 
+    # members the labels of every slot
+    boxes = ndi.find_objects(wsh, max_label=nobjs)
+    alive = np.array([box is not None for box in boxes])
+    owner = np.arange(-1, nobjs)
+    members = [[obj+1] for obj in range(nobjs)]
+    obj_coords = np.array([[box[0].start, box[0].stop, box[1].start, box[1].stop] 
+                           if box is not None else [0, 0, 0, 0] for box in boxes])
+    neighbours = label_adjacency(wsh, nobjs)
     
-    for obj1 in range(wsh.max()):
-        # create masks and dilated masks for obj
-        objs[obj1,:,:] = wsh==(obj1+1)	
-        dil_objs[obj1,:,:] = dilation(objs[obj1,:,:], kernel)	
-        
-        # bounding box
-        obj_coords[obj1,:] = get_bounding_box(dil_objs[obj1,:,:])
+    # new label of every label, painted over by the following merges
+    new_labels = np.zeros(nobjs+1, dtype=np.int64)
     
     objcounter = 0	# counter for new watershed objects
     
-    for obj1 in range(wsh.max()):	
-        dil1 = dil_objs[obj1,:,:]
-
+    for obj1 in range(nobjs):	
         # check if mask has been deleted
-        if np.sum(dil1) == 0:
+        if not alive[obj1]:
             continue
         
         objcounter = objcounter + 1
-        orig1 = objs[obj1,:,:]
+        
+        # cells to compare with, in increasing order
+        candidates = slot_neighbours(obj1, members, neighbours, owner, obj1)
+        seen = set(candidates)
+        heapq.heapify(candidates)
         
         last_obj2_added_to_obj1 = -1
-
-        for obj2 in range(obj1+1,wsh.max()):
-            dil2 = dil_objs[obj2,:,:]
+        
+        while candidates:
+            obj2 = heapq.heappop(candidates)
             
-            # only check border if bounding box overlaps, and second mask 
-            # is not yet deleted
-            if (do_box_overlap(obj_coords[obj1,:], obj_coords[obj2,:])
-                and np.sum(dil2) > 0):
-                
-                border = dil1 * dil2	
-                border_pred = pred[border]
-                
-                # Border is too small to be considered
-                if len(border_pred) < 16:	#SJR: Changed on 18.04.2021 from previously 32. Not sure why 32. I remember 8.
-                    continue
-                
-                # Sum of top 25% of predicted border values
-                q75 = np.quantile(border_pred, .75)
-                top_border_pred = border_pred[border_pred >= q75]
-                top_border_height = top_border_pred.sum()
-                top_border_area = len(top_border_pred)
+            # second mask is already deleted
+            if not alive[obj2]:
+                continue
+            
+            border_pred = border_values(wsh, pred, owner, obj_coords, obj1, obj2)
+            
+            # Border is too small to be considered
+            if len(border_pred) < 16:	#SJR: Changed on 18.04.2021 from previously 32. Not sure why 32. I remember 8.
+                continue
+            
+            # Sum of top 25% of predicted border values
+            q75 = np.quantile(border_pred, .75)
+            top_border_pred = border_pred[border_pred >= q75]
+            top_border_height = top_border_pred.sum()
+            top_border_area = len(top_border_pred)
+            
+            # merge cells
+            if top_border_height / top_border_area > .99:
+                members[obj1] = members[obj1] + members[obj2]
+                owner[members[obj2]] = obj1
+                alive[obj2] = False
+                obj_coords[obj1,:] = merge_boxes(obj_coords[obj1,:], obj_coords[obj2,:])
+                last_obj2_added_to_obj1 = obj2
                 
-                # merge cells
-                if top_border_height / top_border_area > .99:
-                    orig1 = np.logical_or(orig1, objs[obj2,:,:])
-                    dil1 = np.logical_or(dil1, dil2)
-                    dil_objs[obj1,:,:] = dil1
-                    dil_objs[obj2,:,:] = np.zeros((wshshape[0], wshshape[1]))
-                    obj_coords[obj1,:] = get_bounding_box(dil_objs[obj1,:,:])
-#                    obj_coords[obj2,:] = get_bounding_box(dil_objs[obj2,:,:])
-                    last_obj2_added_to_obj1 = obj2
+                # the cells touching obj2 which come after it are compared too
+                for obj3 in slot_neighbours(obj2, members, neighbours, owner, obj2):
+                    if obj3 not in seen:
+                        seen.add(obj3)
+                        heapq.heappush(candidates, obj3)
         
         # the last object that obj1 was merged with should be equal to obj1 so that additional cells could be merged with it
         if last_obj2_added_to_obj1 > -1:
             obj2 = last_obj2_added_to_obj1
-            dil_objs[obj2,:,:] = dil1
-            objs[obj2,:,:] = orig1
-            obj_coords[obj2,:] = get_bounding_box(dil_objs[obj2,:,:])
-            
-                    
-        wshclean = (1-orig1)*wshclean + orig1*objcounter
+            members[obj2] = members[obj1]
+            owner[members[obj2]] = obj2
+            alive[obj2] = True
+            obj_coords[obj2,:] = obj_coords[obj1,:]
         
-    # resort wshclean
-    u = np.unique(wshclean)[1:]	#ignore background
-    for obj1 in range(len(u)):
-        wshclean[wshclean==u[obj1]] = obj1 + 1
-            
-    return wshclean
+        new_labels[members[obj1]] = objcounter
+        
+    return relabel_sequential(wsh, new_labels)
 
 
-def do_box_overlap(coord1, coord2):
-    """Checks if boxes, determined by their coordinates, overlap. Safety
-    margin of 2 pixels"""
-    return (
-    (coord1[0] - 2 < coord2[0] and coord1[1] + 2 > coord2[0]
-        or coord2[0] - 2 < coord1[0] and coord2[1] + 2 > coord1[0]) 
-    and (coord1[2] - 2 < coord2[2] and coord1[3] + 2 > coord2[2]
-        or coord2[2] - 2 < coord1[2] and coord2[3] + 2 > coord1[2]))
+def relabel_sequential(wsh, new_labels):
+    """
+    Returns the cleaned watershed, where every label l of wsh is replaced by
+    new_labels[l], renumbered to 1..n in increasing order (0 stays the 
+    background). Done with a lookup table in one pass over the image, the 
+    output is uint16, or uint32 if there are more than 65535 labels.
+    """
+    present = new_labels > 0
+    u = np.unique(new_labels[present])
+    dtype = np.uint16 if len(u) <= np.iinfo(np.uint16).max else np.uint32
+    lut = np.zeros(len(new_labels), dtype=dtype)
+    lut[present] = np.searchsorted(u, new_labels[present]) + 1
+    return lut[wsh]
 
+
+def label_adjacency(wsh, nobjs):
+    """
+    Returns the list of the labels touching every label in wsh (index 0 is 
+    the background), where two labels touch if their 3x3 dilations overlap, 
+    i.e. if they have pixels at most 2 pixels apart in both directions.
+    """
+    h, w = wsh.shape
+    pairs = []
+    for dy in range(0, 3):
+        for dx in range(-2, 3):
+            if dy == 0 and dx <= 0:
+                continue
+            a = wsh[:h-dy, max(0,-dx):w-max(0,dx)]
+            b = wsh[dy:, max(0,dx):w-max(0,-dx)]
+            touch = (a != b) & (a > 0) & (b > 0)
+            pairs.append(np.unique(a[touch].astype(np.int64)*(nobjs+1) + b[touch]))
+    pairs = np.unique(np.concatenate(pairs))
+    a, b = np.divmod(pairs, nobjs+1)
     
-def get_bounding_box(im):
-    """Returns bounding box of object in boolean image"""
-    coords = np.where(im)
+    neighbours = [[] for _ in range(nobjs+1)]
+    for l1, l2 in zip(a.tolist(), b.tolist()):
+        neighbours[l1].append(l2)
+        neighbours[l2].append(l1)
+    return neighbours
+
+
+def slot_neighbours(obj, members, neighbours, owner, after):
+    """Returns the slots, larger than after, of the cells touching the cells 
+    in slot obj"""
+    labels = [l for m in members[obj] for l in neighbours[m]]
+    slots = np.unique(owner[labels]) if labels else []
+    return [int(o) for o in slots if o > after and o != obj]
+
+
+def border_values(wsh, pred, owner, obj_coords, obj1, obj2):
+    """
+    Returns the predicted values on the border of the cells in slots obj1 and
+    obj2, which is the overlap of their 3x3 dilations. It is computed on a 
+    crop around the smaller of the two, large enough that the dilation is the
+    same as on the whole image.
+    """
+    def area(c): 
+        return (c[1]-c[0])*(c[3]-c[2])
+    c = min(obj_coords[obj1], obj_coords[obj2], key=area)
+    crop = (slice(max(c[0]-2, 0), c[1]+2), slice(max(c[2]-2, 0), c[3]+2))
     
-    return np.array([np.min(coords[0]), np.max(coords[0]), 
-                     np.min(coords[1]), np.max(coords[1])])
+    slots = owner[wsh[crop]]
+    kernel = np.ones((3,3), dtype=bool)
+    border = dilation(slots==obj1, kernel) & dilation(slots==obj2, kernel)
+    return pred[crop][border]
+
+
+def merge_boxes(coord1, coord2):
+    """Returns the bounding box of two bounding boxes"""
+    return np.array([min(coord1[0], coord2[0]), max(coord1[1], coord2[1]),
+                     min(coord1[2], coord2[2]), max(coord1[3], coord2[3])])